@@ -5,8 +5,41 @@
 import json
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+# Files larger than 8 MB are downloaded with parallel byte-range requests
+TRANSFER_CFG = TransferConfig(
+  multipart_threshold=8*1024*1024,
+  multipart_chunksize=8*1024*1024,
+  max_concurrency=10,
+  io_chunksize=256*1024
+)
+
+# The connection pool must be large enough for the parallel downloads
+BOTO_CFG = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10}, tcp_keepalive=True)
+
+ORTHANC_CONFIG_PATH = '/tmp/orthanc.json'
+S3_PLUGIN_SRC_PATH = '/usr/share/orthanc/plugins-available/libOrthancAwsS3Storage.so'
+S3_PLUGIN_DST_PATH = '/usr/share/orthanc/plugins/libOrthancAwsS3Storage.so'
+
+
+def copy_file(src, dst):
+  """
+  Copy a file with `os.copy_file_range` so that the data is copied by the kernel without going 
+  through user space. Fall back to `shutil.copy2` if it is not supported.
+  
+  """
+  try:
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+      while os.copy_file_range(f_src.fileno(), f_dst.fileno(), 1 << 20) > 0:
+        pass
+    shutil.copystat(src, dst)
+  except (OSError, AttributeError):
+    shutil.copy2(src, dst)
 
 
 # Configure the S3 plugin
@@ -20,20 +53,35 @@ if bucket != None and region != None:
   if prefix is None:
     prefix = ''
 
-  with open('/tmp/orthanc.json', 'r') as f_read:
-    data = json.load(f_read)
+  with open(ORTHANC_CONFIG_PATH, 'rb') as f_read:
+    data = json.loads(f_read.read())
 
-  data['AwsS3Storage'] = {
-  'BucketName': bucket,
-  'Region': region,
-  'RootPath': prefix
+  s3_storage = {
+    'BucketName': bucket,
+    'Region': region,
+    'RootPath': prefix
   }
 
-  with open('/tmp/orthanc.json', 'w') as f_write:
-    json.dump(data, f_write)
-
-  shutil.copy2('/usr/share/orthanc/plugins-available/libOrthancAwsS3Storage.so', '/usr/share/orthanc/plugins')
-  print('Enabled cloud object storage (S3) plugin: %s' %json.dumps(data['AwsS3Storage']))
+  # Skip writing the Orthanc configuration file if it already contains the same S3 configuration, 
+  # for example when the container restarts
+  if data.get('AwsS3Storage') != s3_storage:
+    data['AwsS3Storage'] = s3_storage
+
+    # Write the Orthanc configuration file to a temporary file first, and replace the existing 
+    # file atomically to prevent Orthanc from reading a half-written file
+    tmp_path = ORTHANC_CONFIG_PATH + '.tmp'
+    with open(tmp_path, 'w') as f_write:
+      json.dump(data, f_write, separators=(',', ':'))
+      f_write.flush()
+      os.fsync(f_write.fileno())
+    os.replace(tmp_path, ORTHANC_CONFIG_PATH)
+
+  # Skip copying the plugin if it was already copied. `copy_file` preserves the modification time
+  src_stat = os.stat(S3_PLUGIN_SRC_PATH)
+  dst_stat = os.stat(S3_PLUGIN_DST_PATH) if os.path.exists(S3_PLUGIN_DST_PATH) else None
+  if dst_stat is None or (dst_stat.st_size, dst_stat.st_mtime_ns) != (src_stat.st_size, src_stat.st_mtime_ns):
+    copy_file(S3_PLUGIN_SRC_PATH, S3_PLUGIN_DST_PATH)
+  print('Enabled cloud object storage (S3) plugin: BucketName=%s Region=%s RootPath=%s' %(bucket, region, prefix))
 
 else:
   print('Disabled cloud object storage (S3) plugin')
@@ -45,22 +93,44 @@ bucket = os.getenv('RPACS_S3_CONFIG_BUCKET_NAME')
 region = os.getenv('RPACS_S3_CONFIG_AWS_REGION')
 prefix = os.getenv('RPACS_S3_CONFIG_KEY_PREFIX')
 local_dir='/s3-files/'
+verbose = os.getenv('RPACS_VERBOSE') == '1'
 
 if bucket != None and region != None:
   
   if prefix is None:
     prefix = ''
 
-  s3_resource = boto3.resource('s3', region_name=region)
-  bucket_resource = s3_resource.Bucket(bucket)
-  
-  for obj in bucket_resource.objects.filter(Prefix=prefix):
+  s3_client = boto3.client('s3', region_name=region, config=BOTO_CFG)
+
+  def download_file(key, local_path):
+    s3_client.download_file(Bucket=bucket, Key=key, Filename=local_path, Config=TRANSFER_CFG)
+    if verbose:
+      print('Copied file s3://%s/%s to %s' %(bucket, key, local_path))
+
+  # List the configuration files and create the local directories once per unique directory, 
+  # before the downloads start
+  files_to_download = []
+  total_bytes = 0
+  created_dirs = set()
+  paginator = s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+    for obj in page.get('Contents', []):
+      if not obj['Key'].endswith('/'):
+        local_path = local_dir + obj['Key'][len(prefix):]
+        local_dirname = os.path.dirname(local_path)
+        if not local_dirname in created_dirs:
+          os.makedirs(local_dirname, exist_ok=True)
+          created_dirs.add(local_dirname)
+        files_to_download.append((obj['Key'], local_path))
+        total_bytes += obj['Size']
+
+  # Download the configuration files in parallel, since the container startup is bound by the 
+  # round-trip time of each small GET request rather than by the bandwidth
+  with ThreadPoolExecutor(max_workers=16) as executor:
+    futures = [executor.submit(download_file, key, local_path) for key, local_path in files_to_download]
     
-    if not obj.key.endswith('/'):
-      local_path = local_dir + obj.key[len(prefix):]
-      
-      if not os.path.exists(os.path.dirname(local_path)):
-        os.makedirs(os.path.dirname(local_path))
-        
-      bucket_resource.download_file(obj.key, local_path)
-      print('Copied file s3://%s/%s to %s' %(bucket, obj.key, local_path))
+    # Raise an exception if any of the downloads failed
+    for future in futures:
+      future.result()
+
+  print('Copied %d files (%.1f MB) from s3://%s/%s to %s' %(len(files_to_download), total_bytes/1e6, bucket, prefix, local_dir))
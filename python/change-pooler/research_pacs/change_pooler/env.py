@@ -1,7 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from research_pacs.shared.util import EnvVarList
+from research_pacs.shared.util import EnvVarList, check_orthanc_hostname
 
 
 def get_env():
@@ -30,9 +30,7 @@ def get_env():
   
   # Hostname of the Orthanc server. Format: http[s]://hostname (do not include a trailing slash)
   env.add('orthanc_host', 'RPACS_ORTHANC_HOSTNAME')
-  host_lower = env.orthanc_host.lower()
-  assert host_lower.startswith('http://') or host_lower.startswith('https://'), 'Orthanc hostname format is incorrect'
-  assert not host_lower.endswith('/'), 'Orthanc hostname format is incorrect'
+  check_orthanc_hostname(env.orthanc_host)
   
   # User name to use to connect to the Orthanc server
   env.add('orthanc_user', 'RPACS_ORTHANC_USERNAME')
@@ -40,4 +38,12 @@ def get_env():
   # Password to use to connect to the Orthanc server
   env.add('orthanc_pwd', 'RPACS_ORTHANC_PASSWORD', password=True)
   
+  # Minimum and maximum number of seconds to wait between two Orthanc polls. The waiting time 
+  # doubles after each poll that returned no change, and is reset to the minimum otherwise
+  env.add('poll_min_secs', 'RPACS_POLL_MIN_SECS', cast=int, default=1)
+  env.add('poll_max_secs', 'RPACS_POLL_MAX_SECS', cast=int, default=30)
+  
+  # Maximum number of Orthanc changes to retrieve in each request
+  env.add('orthanc_changes_limit', 'RPACS_ORTHANC_CHANGES_LIMIT', cast=int, default=1000)
+  
   return env
@@ -1,11 +1,13 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import json
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import orjson
+from botocore.config import Config
 
 from research_pacs.change_pooler.env import get_env
 from research_pacs.shared.database import DB, DBKeyJsonValue
@@ -16,14 +18,16 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 env = None
 client = None
+queue_url = None
 
 
 def main():
   logger.info('Starting change pooler')
 
   try:
-    global env
+    global env, queue_url
     env = get_env()
+    queue_url = env.queue_url
     
     # Create the clients
     global client
@@ -31,20 +35,38 @@ def main():
     client.add('db', DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db))
     client.add('db_last_state', DBKeyJsonValue(client.db, table_name="rpacs_change_pooler_last_state"))
     client.add('orthanc', OrthancClient(env.orthanc_host, env.orthanc_user, env.orthanc_pwd))
-    client.add('sqs', boto3.client('sqs', region_name=env.region))
+    boto_config = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10}, tcp_keepalive=True)
+    client.add('sqs', boto3.client('sqs', region_name=env.region, config=boto_config))
+    
+    # Thread pool used to send several batches of SQS messages concurrently
+    client.add('sqs_executor', ThreadPoolExecutor(max_workers=10))
 
     # Retrieve the last Orthanc change ID (Seq) already processed from the database
     last_state = client.db_last_state.get(key=env.orthanc_host, init_value={"last_seq": 0})
     current_last_seq = last_state['last_seq']
-    logger.info(f'Last Orthanc change ID (Seq) already processed = {current_last_seq}')
+    logger.info('Last Orthanc change ID (Seq) already processed = %s', current_last_seq)
     
     # This variable will be set to True if we fail to update the last change ID (Seq) that 
     # was processed in the database
     db_update_orthanc_failed = False
+    
+    # Number of consecutive iterations that returned no Orthanc change, used to increase the 
+    # waiting time between two iterations when Orthanc is idle
+    empty_iters = 0
+    
+    # Change IDs (Seq) whose SQS message was already sent, but that are after the first change 
+    # whose message failed. They are skipped when these changes are processed again
+    delivered_seqs = set()
+    
+    # Environment variables used in each loop iteration
+    orthanc_host = env.orthanc_host
+    poll_min_secs = env.poll_min_secs
+    poll_max_secs = env.poll_max_secs
+    orthanc_changes_limit = env.orthanc_changes_limit
   
   # Exit if any of the previous initialization steps failed
   except Exception as e:
-    logger.fatal(f'Failed to initialize the program - {e}')
+    logger.fatal('Failed to initialize the program - %s', e)
     sys.exit(1)
 
   # Loop until the program is interrupted by SIGINT or SIGTERM
@@ -54,67 +76,119 @@ def main():
     # Retrieve and process the changes that occured in Orthanc whose change ID (Seq) is larger 
     # than `current_last_seq`
     try:
-      changes, last_seq = client.orthanc.get_changes(from_seq=current_last_seq)
+      # Re-use the database connection from the previous iteration if it is still usable
+      client.db.ensure_open()
+      
+      changes, last_seq = client.orthanc.get_changes(from_seq=current_last_seq, limit=orthanc_changes_limit)
       new_last_seq = current_last_seq
+      if len(changes) == 0:
+        empty_iters += 1
+      else:
+        empty_iters = 0
       
       # If you run Orthanc with no persistent storage, the Orthanc change ID is zeroed if you lose 
       # the Orthanc database content. In that case, we reset the change ID to zero.
       if last_seq < current_last_seq:
-        logger.warning(f'Orthanc may have been reinitialized. Setting the last Orthanc change ID (Seq) to 0')
+        logger.warning('Orthanc may have been reinitialized. Setting the last Orthanc change ID (Seq) to 0')
         new_last_seq = 0
+        delivered_seqs.clear()
 
       else:
+        new_instances = []
         for change in changes:
-          logger.debug(f'New Orthanc change: {json.dumps(change)}')
-          
-          if change['ChangeType'] == 'NewInstance':
-            logger.info(f"New DICOM instance in Orthanc - ID={change['ID']}")
-            
-            # Send a SQS message to notify of the new DICOM instance. If the message could not be 
-            # sent, we interrupt the loop iteration and retry later
-            if send_sqs_message({'EventType': 'NewDICOM', 'Source': f"orthanc://{change['ID']}"}) is False:
-              break
-          
-          # Increment the last Orthanc change ID already processed
-          new_last_seq = change['Seq']
+          if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('New Orthanc change: %s', orjson.dumps(change).decode())
+          handler = CHANGE_HANDLERS.get(change['ChangeType'])
+          if handler != None:
+            handler(change, new_instances)
+        
+        # Send SQS messages to notify of the new DICOM instances by batches of 10 messages. The 
+        # batches are sent concurrently to overlap the SQS round-trips
+        new_instances = [i for i in new_instances if not i['Seq'] in delivered_seqs]
+        batches = [new_instances[i:i+10] for i in range(0, len(new_instances), 10)]
+        failed_changes = [i for failed in client.sqs_executor.map(send_sqs_batch, batches) for i in failed]
+        
+        # Increment the last Orthanc change ID already processed. If a message could not be sent, 
+        # we retry later from the first change whose message failed, and remember the changes 
+        # after it whose message was sent so that they are not sent twice
+        if len(failed_changes) > 0:
+          new_last_seq = min(i['Seq'] for i in failed_changes) - 1
+          failed_seqs = set(i['Seq'] for i in failed_changes)
+          delivered_seqs.update(i['Seq'] for i in new_instances if not i['Seq'] in failed_seqs)
+        elif len(changes) > 0:
+          new_last_seq = changes[-1]['Seq']
+        delivered_seqs.difference_update([i for i in delivered_seqs if i <= new_last_seq])
         
       # Update the last Orthanc change ID in the database, if its value changed or if the previous 
       # update failed
       if new_last_seq != current_last_seq or db_update_orthanc_failed is True:
         current_last_seq = new_last_seq
         try:
-          client.db_last_state.update(key=env.orthanc_host, new_value_dict={"last_seq": current_last_seq})
+          client.db_last_state.update(key=orthanc_host, new_value_dict={"last_seq": current_last_seq})
           db_update_orthanc_failed = False
         except Exception as e:
-          logger.warning(f'Failed to update the last Orthanc change ID - {e}')
+          logger.warning('Failed to update the last Orthanc change ID - %s', e)
           db_update_orthanc_failed = True
           
     except Exception as e:
-      logger.error(f'Failed to get and process Orthanc changes - {e}')
+      logger.error('Failed to get and process Orthanc changes - %s', e)
 
-    # Close the DB connection after each iteration
-    client.db.close()
-
-    # Wait 5 seconds before the next iteration
-    logger.debug(f"Waiting 5 seconds")
-    killer.sleep(5)
+    # Wait before the next iteration. The waiting time doubles after each iteration that returned 
+    # no change, up to `poll_max_secs`
+    sleep_secs = min(poll_max_secs, poll_min_secs * (1 << min(empty_iters, 16)))
+    logger.debug('Waiting %s seconds', sleep_secs)
+    killer.sleep(sleep_secs)
 
   # Before the program exits
+  client.sqs_executor.shutdown()
+  client.db.close()
   logger.info('Stopping change pooler')
 
 
-def send_sqs_message(message_dict):
+def handle_new_instance(change, new_instances):
+  """
+  Add a NewInstance change to the list of new DICOM instances to notify via SQS.
+  
+  Args:
+    change (dict): Orthanc change
+    new_instances (list): List of NewInstance changes for the current iteration
+  
+  """
+  logger.info('New DICOM instance in Orthanc - ID=%s', change['ID'])
+  new_instances.append(change)
+
+
+# Functions that process each type of Orthanc change. Other change types are ignored
+CHANGE_HANDLERS = {
+  'NewInstance': handle_new_instance
+}
+
+
+def send_sqs_batch(changes):
   """
-  Sends a SQS message. Returns True if succeeded, False otherwise.
+  Sends a SQS message for each NewInstance change in a single batch (10 changes maximum). Returns 
+  the list of changes whose message could not be sent.
+  
+  Args:
+    changes (list): List of NewInstance changes
   
   """
   try:
-    logger.debug('Sending a SQS message')
-    client.sqs.send_message(
-      QueueUrl=env.queue_url,
-      MessageBody=json.dumps(message_dict)
+    logger.debug('Sending a batch of %s SQS messages', len(changes))
+    response = client.sqs.send_message_batch(
+      QueueUrl=queue_url,
+      Entries=[
+        {
+          'Id': str(i_change),
+          'MessageBody': orjson.dumps({'EventType': 'NewDICOM', 'Source': f"orthanc://{change['ID']}"}).decode()
+        }
+        for i_change, change in enumerate(changes)
+      ]
     )
-    return True
+    failed_ids = [int(failed['Id']) for failed in response.get('Failed', [])]
+    if len(failed_ids) > 0:
+      logger.error('Failed to send %s messages to SQS - %s', len(failed_ids), response['Failed'][0].get('Message'))
+    return [changes[i] for i in failed_ids]
   except Exception as e:
-    logger.error(f'Failed to send a message to SQS - {e}')
-    return False
+    logger.error('Failed to send messages to SQS - %s', e)
+    return changes
@@ -8,6 +8,7 @@ setup(
   version="1.0",
   packages=['research_pacs.change_pooler'],
   install_requires=[
-    'boto3',
+    'boto3[crt]>=1.26',
+    'orjson'
   ]
 )
\ No newline at end of file
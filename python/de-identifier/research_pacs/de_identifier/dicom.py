@@ -2,12 +2,14 @@
 # SPDX-License-Identifier: MIT-0
 
 import datetime
+import itertools
 import logging
-import json
 import random
 import string
+import threading
 
 import numpy as np
+import orjson
 import pydicom
 
 import research_pacs.de_identifier.dicom_tag_path as dicom_tp
@@ -19,6 +21,98 @@ import research_pacs.shared.validation as rpacs_v
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Config files that were already validated and adapted, indexed by their JSON representation. 
+# The de-identifier usually processes many DICOM files with the same config file, which only needs 
+# to be validated once. The cache is shared by the worker threads and guarded by a lock
+_validated_configs = {}
+_validated_configs_lock = threading.Lock()
+_VALIDATED_CONFIGS_MAX_SIZE = 16
+
+VALID_REUSE_VALUE = ('Always', 'SamePatient', 'SameStudy', 'SameSeries', 'SameInstance')
+
+# Expected attributes of the items of each transformation type, in the format expected by 
+# `rpacs_v.check_dict_attributes`. The transformation types whose items must contain 
+# `TagPatterns` and `ExceptTagPatterns` are listed in `TAG_PATTERN_TRANSFORMATIONS`
+TRANSFORMATION_SCHEMAS = {
+  
+  # ShiftDateTime
+  #   - TagPatterns: str or list              List of UID tag patterns to shift
+  #     ExceptTagPatterns: str or list        Except this list of tag patterns
+  #     ShiftBy: int                          Will shift by a random number of days (if Date) 
+  #                                           or seconds (if DateTime or Time) between
+  #                                           `-ShiftBy` and `+ShiftBy`
+  #     ReuseMapping: str                     [Optional] Scope of the mapping
+  'ShiftDateTime': {
+    'ShiftBy': {'Type': int},
+    'ReuseMapping': {'Type': str, 'Optional': True, 'Values': VALID_REUSE_VALUE}
+  },
+  
+  # RandomizeText
+  #   - TagPatterns: str or list              List of UID tag patterns to shift
+  #     ExceptTagPatterns: str or list        Except this list of tag patterns
+  #     Split: str                            Split the element value on `Split` and randomize
+  #                                           each item obtained separately
+  #     IgnoreCase: bool                      Specified whether the original value must be 
+  #                                           lowercased before being randomized. Default is
+  #                                           `False`.
+  #     ReuseMapping: str                     [Optional] Scope of the mapping
+  'RandomizeText': {
+    'Split': {'Type': str, 'Optional': True, 'Default': None},
+    'IgnoreCase': {'Type': bool, 'Optional': True, 'Default': False},
+    'ReuseMapping': {'Type': str, 'Optional': True, 'Values': VALID_REUSE_VALUE}
+  },
+  
+  # RandomizeUID:
+  #   - TagPatterns: str or list              List of UID tag patterns to randomize
+  #     ExceptTagPatterns: str or list        Except this list of tag patterns
+  #     PrefixUID: str                        [Optional] UID prefix to use when creating the 
+  #                                           UID. Default is the pydicom root UID
+  'RandomizeUID': {
+    'Prefix': {'Type': str, 'Optional': True}
+  },
+  
+  # AddTags
+  #   - Tag: str                              Tag path
+  #     VR: str                               Value Representation of the tag
+  #     Value: str                            Value of the tag to create
+  #     OverwriteIfExists                     If the tag already exists, set `True` to 
+  #                                           overwrite its value. Default is `False`
+  'AddTags': {
+    'Tag': {'Type': str},
+    'VR': {'Type': str},
+    'Value': {'Type': str},
+    'OverwriteIfExists': {'Type': bool, 'Optional': True, 'Default': False}
+  },
+  
+  # RemoveBurnedInAnnotations:
+  #   - Type: str                     OCR or Manual
+  #     BoxCoordinates: list          [Conditional] Provide a list of box coordinates. Each 
+  #                                   box coordinate is a 4-element list with integer (left, 
+  #                                   top, right, bottom)
+  'RemoveBurnedInAnnotations': {
+    'Type': {'Type': str, 'Values': ('OCR', 'Manual')}
+  },
+  
+  # DeleteTags:
+  #   - TagPatterns: str or list                      List of tag patterns to remove
+  #     ExceptTagPatterns: str or list                List of tag patterns to retain
+  #     Action: str                                   Remove or Empty
+  'DeleteTags': {
+    'Action': {'Type': str, 'Values': ('Remove', 'Empty')}
+  }
+  
+}
+TAG_PATTERN_TRANSFORMATIONS = ('ShiftDateTime', 'RandomizeText', 'RandomizeUID', 'DeleteTags')
+
+# Characters used to generate random strings in RandomizeText
+_RANDOM_TEXT_ALPHABET = string.ascii_letters + string.digits
+
+# New UIDs generated by RandomizeUID are made of a prefix, a random number drawn once per process 
+# and a counter. This is much faster than `pydicom.uid.generate_uid`, which hashes a new UUID with 
+# SHA512 for each UID
+_uid_process_id = random.SystemRandom().getrandbits(64)
+_uid_counter = itertools.count(1)
+
 
 class DicomDeidentifier:
   """
@@ -49,10 +143,27 @@ class DicomDeidentifier:
     self._db_mapping = db_mapping
     self.dicom = None
     try:
-      logger.debug('Validating the content of the config file')
-      self._validate_and_adapt_config_file()
+      config_key = orjson.dumps(config, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
     except Exception as e:
       raise Exception(f'The config file is invalid - {e}')
+    
+    # Reuse the validated config file if the same config file was already validated
+    with _validated_configs_lock:
+      validated_config = _validated_configs.get(config_key)
+    if validated_config != None:
+      logger.debug('Reusing the validated content of the config file')
+      self._config, self._scope_masks = validated_config
+    else:
+      try:
+        logger.debug('Validating the content of the config file')
+        self._validate_and_adapt_config_file()
+        self._scope_masks = self._compile_scope_rules()
+      except Exception as e:
+        raise Exception(f'The config file is invalid - {e}')
+      with _validated_configs_lock:
+        if len(_validated_configs) >= _VALIDATED_CONFIGS_MAX_SIZE:
+          del _validated_configs[next(iter(_validated_configs))]
+        _validated_configs[config_key] = (self._config, self._scope_masks)
   
   
   def load_dicom(self, dicom_bytes, src_transfer_syntax=None, initial_load=True):
@@ -79,7 +190,11 @@ class DicomDeidentifier:
     
     if initial_load is True:
       self._matching_labels = self._find_matching_labels()
-      skipped = not self._do_labels_match_scope_rules(self._matching_labels, self._config['ScopeToForward'])
+      label_bits, forward_masks, transformation_masks = self._scope_masks
+      self._matching_labels_mask = 0
+      for label in self._matching_labels:
+        self._matching_labels_mask |= label_bits[label]
+      skipped = not self._do_labels_match_scope_rules(self._matching_labels_mask, forward_masks)
       if skipped is False:
         self._transformations, self._remove_burned_in_annotations, self._use_ocr = self._find_transformations_to_apply()
       return self._matching_labels, skipped
@@ -111,25 +226,18 @@ class DicomDeidentifier:
     Transformations: list                 List of transformations to apply
       - Scope: dict                       Scope to which the transformation specified in this item 
                                           should apply. Similar to "ScopeToForward"
-        [See below]                       See inline comments for the possible types of 
-                                          transformations
+        [See below]                       See `TRANSFORMATION_SCHEMAS` for the possible 
+                                          types of transformations
         
     """
-    VALID_REUSE_VALUE = ('Always', 'SamePatient', 'SameStudy', 'SameSeries', 'SameInstance')
+    label_names = set()
+    category_names = set()
     
     def label_exists(label_name):
-      for label in self._config['Labels']:
-        if label['Name'] == label_name:
-          return True
-      return False
+      return label_name in label_names
       
     def category_exists(category_name):
-      if not 'Categories' in self._config:
-        return False
-      for category in self._config['Categories']:
-        if category['Name'] == category_name:
-          return True
-      return False
+      return category_name in category_names
       
     def check_scope_rules(rules, path):
       """
@@ -154,7 +262,8 @@ class DicomDeidentifier:
     def check_tag_patterns_exist(element, path):
       """
       Check if the element contains an attribute "TagPatterns" that is a path pattern or a list of 
-      path patterns, and an optional "ExceptTagPatterns".
+      path patterns, and an optional "ExceptTagPatterns". The tag path patterns are compiled once 
+      here, so that they are not parsed again when processing each DICOM file.
       
       Args:
         element (dict)
@@ -165,11 +274,13 @@ class DicomDeidentifier:
       element['TagPatterns'] = rpacs_v.check_or_form_list_of_str(element['TagPatterns'], f'{path}["TagPatterns"]')
       for i_tag_pattern, tag_pattern in enumerate(element['TagPatterns']):
         assert dicom_tpp.is_tag_path_pattern(tag_pattern), f'{path}["TagPatterns"][{i_tag_pattern}] is not a valid tag pattern'
+        dicom_tpp.compile_tag_path_pattern(tag_pattern)
       
       if 'ExceptTagPatterns' in element:
         element['ExceptTagPatterns'] = rpacs_v.check_or_form_list_of_str(element['ExceptTagPatterns'], f'{path}["ExceptTagPatterns"]')
         for i_tag_pattern, tag_pattern in enumerate(element['ExceptTagPatterns']):
           assert dicom_tpp.is_tag_path_pattern(tag_pattern), f'{path}["ExceptTagPatterns"][{i_tag_pattern}] is not a valid tag pattern'
+          dicom_tpp.compile_tag_path_pattern(tag_pattern)
       else:
         element['ExceptTagPatterns'] = []
 
@@ -177,6 +288,7 @@ class DicomDeidentifier:
     rpacs_v.check_dict_attribute_exists_and_type(self._config, 'Labels', list, 'config')
     for i_label, label in rpacs_v.enumerate_list_and_check_item_type(self._config['Labels'], dict, 'config["Labels"]'):
       rpacs_v.check_dict_attribute_exists_and_type(label, 'Name', str, f'config["Labels"][{i_label}]')
+      label_names.add(label['Name'])
 
       # Check that `DICOMQueryFilter` is valid, if it is specified and not empty. Translate and 
       # store the associated JSON Path query into `label['JSONPathQuery']`
@@ -190,6 +302,7 @@ class DicomDeidentifier:
     if rpacs_v.check_dict_attribute_exists_and_type(self._config, 'Categories', list, 'config', optional=True) is True:
       for i_category, category in rpacs_v.enumerate_list_and_check_item_type(self._config['Categories'], dict, 'config["Categories"]'):
         rpacs_v.check_dict_attribute_exists_and_type(category, 'Name', str, f'config["Categories"][{i_category}]')
+        category_names.add(category['Name'])
         rpacs_v.check_dict_attribute_exists_and_type(category, 'Labels', list, f'config["Categories"][{i_category}]')
         rpacs_v.check_list_item_type(category['Labels'], str, f'config["Categories"][{i_category}]["Labels"]')
 
@@ -204,90 +317,30 @@ class DicomDeidentifier:
       rpacs_v.check_dict_attribute_exists_and_type(t, 'Scope', dict, t_path)
       check_scope_rules(t['Scope'], f'{t_path}["Scope"]')
 
-      # ShiftDateTime
-      #   - TagPatterns: str or list              List of UID tag patterns to shift
-      #     ExceptTagPatterns: str or list        Except this list of tag patterns
-      #     ShiftBy: int                          Will shift by a random number of days (if Date) 
-      #                                           or seconds (if DateTime or Time) between
-      #                                           `-ShiftBy` and `+ShiftBy`
-      #     ReuseMapping: str                     [Optional] Scope of the mapping
-      if rpacs_v.check_dict_attribute_exists_and_type(t, 'ShiftDateTime', list, t_path, optional=True) is True:
-        for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t['ShiftDateTime'], dict, f'{t_path}["ShiftDateTime"]'):
-          check_tag_patterns_exist(element, f'{t_path}["ShiftDateTime"][{i_element}]')
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'ShiftBy', int, f'{t_path}["ShiftDateTime"]')
-          if rpacs_v.check_dict_attribute_exists_and_type(element, 'ReuseMapping', str, f'{t_path}["ShiftDateTime"]', optional=True) is True:
-            assert element['ReuseMapping'] in VALID_REUSE_VALUE, f'{t_path}["ShiftDateTime"][{i_element}]["ReuseMapping"] is invalid'
-
-      # RandomizeText
-      #   - TagPatterns: str or list              List of UID tag patterns to shift
-      #     ExceptTagPatterns: str or list        Except this list of tag patterns
-      #     Split: str                            Split the element value on `Split` and randomize
-      #                                           each item obtained separately
-      #     IgnoreCase: bool                      Specified whether the original value must be 
-      #                                           lowercased before being randomized. Default is
-      #                                           `False`.
-      #     ReuseMapping: str                     [Optional] Scope of the mapping
-      if rpacs_v.check_dict_attribute_exists_and_type(t, 'RandomizeText', list, t_path, optional=True) is True:
-        for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t['RandomizeText'], dict, f'{t_path}["RandomizeText"]'):
-          check_tag_patterns_exist(element, f'{t_path}["RandomizeText"][{i_element}]')
-          if rpacs_v.check_dict_attribute_exists_and_type(element, 'Split', str, f'{t_path}["RandomizeText"]', optional=True) is False:
-            element['Split'] = None
-          if rpacs_v.check_dict_attribute_exists_and_type(element, 'IgnoreCase', bool, f'{t_path}["RandomizeText"]', optional=True) is False:
-            element['IgnoreCase'] = False
-          if rpacs_v.check_dict_attribute_exists_and_type(element, 'ReuseMapping', str, f'{t_path}["RandomizeText"]', optional=True) is True:
-            assert element['ReuseMapping'] in VALID_REUSE_VALUE, f'{t_path}["RandomizeText"][{i_element}]["ReuseMapping"] is invalid'
-
-      # RandomizeUID:
-      #   - TagPatterns: str or list              List of UID tag patterns to randomize
-      #     ExceptTagPatterns: str or list        Except this list of tag patterns
-      #     PrefixUID: str                        [Optional] UID prefix to use when creating the 
-      #                                           UID. Default is the pydicom root UID
-      if rpacs_v.check_dict_attribute_exists_and_type(t, 'RandomizeUID', list, t_path, optional=True) is True:
-        for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t['RandomizeUID'], dict, f'{t_path}["RandomizeUID"]'):
-          check_tag_patterns_exist(element, f'{t_path}["RandomizeUID"][{i_element}]')
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'Prefix', str, f'{t_path}["RandomizeUID"]', optional=True)
-      
-      # AddTags
-      #   - Tag: str                              Tag path
-      #     VR: str                               Value Representation of the tag
-      #     Value: str                            Value of the tag to create
-      #     OverwriteIfExists                     If the tag already exists, set `True` to 
-      #                                           overwrite its value. Default is `False`
-      if rpacs_v.check_dict_attribute_exists_and_type(t, 'AddTags', list, t_path, optional=True) is True:
-        for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t['AddTags'], dict, f'{t_path}["AddTags"]'):
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'Tag', str, f'{t_path}["AddTags"]')
-          assert dicom_tp.is_tag_path(element['Tag']), f'{t_path}["AddTags"][{i_element}]["Tag"] is not a valid tag path'
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'VR', str, f'{t_path}["AddTags"]')
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'Value', str, f'{t_path}["AddTags"]')
-          if rpacs_v.check_dict_attribute_exists_and_type(element, 'OverwriteIfExists', bool, f'{t_path}["AddTags"]', optional=True) is False:
-            element['OverwriteIfExists'] = False
-      
-      # RemoveBurnedInAnnotations:
-      #   - Type: str                     OCR or Manual
-      #     BoxCoordinates: list          [Conditional] Provide a list of box coordinates. Each 
-      #                                   box coordinate is a 4-element list with integer (left, 
-      #                                   top, right, bottom)
-      if rpacs_v.check_dict_attribute_exists_and_type(t, 'RemoveBurnedInAnnotations', list, t_path, optional=True) is True:
-        for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t['RemoveBurnedInAnnotations'], dict, f'{t_path}["RemoveBurnedInAnnotations"]'):
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'Type', str, f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]')
-          assert element['Type'] in ('OCR', 'Manual'), f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]["Type"] must be equal to "OCR" or "Manual"'
-          
-          if element['Type'] == 'Manual':
-            rpacs_v.check_dict_attribute_exists_and_type(element, 'BoxCoordinates', list, f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]')
-            for i_box, box in rpacs_v.enumerate_list_and_check_item_type(element['BoxCoordinates'], list, f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]["BoxCoordinates"]'):
-              rpacs_v.check_list_item_type(box, int, f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]["BoxCoordinates"][{i_box}]')
-              assert len(box) == 4, f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]["BoxCoordinates"][{i_box}] is not a 4-element list'
-              assert box[0] < box[2] and box[1] < box[3], f'{t_path}["RemoveBurnedInAnnotations"][{i_element}]["BoxCoordinates"][{i_box}] contains invalid coordinates'
-
-      # DeleteTags:
-      #   - TagPatterns: str or list                      List of tag patterns to remove
-      #     ExceptTagPatterns: str or list                List of tag patterns to retain
-      #     Action: str                                   Remove or Empty
-      if rpacs_v.check_dict_attribute_exists_and_type(t, 'DeleteTags', list, t_path, optional=True) is True:
-        for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t['DeleteTags'], dict, f'{t_path}["DeleteTags"]'):
-          check_tag_patterns_exist(element, f'{t_path}["DeleteTags"][{i_element}]')
-          rpacs_v.check_dict_attribute_exists_and_type(element, 'Action', str, f'{t_path}["DeleteTags"][{i_element}]')
-          assert element['Action'] in ('Remove', 'Empty'), f'{t_path}["DeleteTags"][{i_element}]["Action"] must be equal to "Remove" or "Empty"'
+      # Check the items of each transformation type against `TRANSFORMATION_SCHEMAS`
+      for t_type, schema in TRANSFORMATION_SCHEMAS.items():
+        if rpacs_v.check_dict_attribute_exists_and_type(t, t_type, list, t_path, optional=True) is True:
+          for i_element, element in rpacs_v.enumerate_list_and_check_item_type(t[t_type], dict, f'{t_path}["{t_type}"]'):
+            element_path = f'{t_path}["{t_type}"][{i_element}]'
+            if t_type in TAG_PATTERN_TRANSFORMATIONS:
+              check_tag_patterns_exist(element, element_path)
+            rpacs_v.check_dict_attributes(element, schema, element_path)
+            
+            # AddTags: `Tag` must be a valid tag path
+            if t_type == 'AddTags':
+              assert dicom_tp.is_tag_path(element['Tag']), f'{element_path}["Tag"] is not a valid tag path'
+            
+            # RemoveBurnedInAnnotations: `BoxCoordinates` is required if `Type` is `Manual`
+            if t_type == 'RemoveBurnedInAnnotations' and element['Type'] == 'Manual':
+              rpacs_v.check_dict_attribute_exists_and_type(element, 'BoxCoordinates', list, element_path)
+              for i_box, box in rpacs_v.enumerate_list_and_check_item_type(element['BoxCoordinates'], list, f'{element_path}["BoxCoordinates"]'):
+                rpacs_v.check_list_item_type(box, int, f'{element_path}["BoxCoordinates"][{i_box}]')
+                assert len(box) == 4, f'{element_path}["BoxCoordinates"][{i_box}] is not a 4-element list'
+              
+              # Check that left < right and top < bottom for all boxes at once
+              boxes = np.array(element['BoxCoordinates'], dtype=np.int64).reshape(-1, 4)
+              invalid_boxes = np.flatnonzero((boxes[:, 0] >= boxes[:, 2]) | (boxes[:, 1] >= boxes[:, 3]))
+              assert len(invalid_boxes) == 0, f'{element_path}["BoxCoordinates"][{invalid_boxes[0]}] contains invalid coordinates'
 
       # Transcode: str                    Transfer syntax UID to which the de-identified DICOM
       #                                   file should be transcoded. If not provided, the 
@@ -306,10 +359,11 @@ class DicomDeidentifier:
     transformations = {}
     remove_burned_in_annotations = False
     use_ocr = False
-    for t in self._config['Transformations']:
+    label_bits, forward_masks, transformation_masks = self._scope_masks
+    for t, t_masks in zip(self._config['Transformations'], transformation_masks):
       
       # Check if the transformation should be apply based on the matching labels
-      if self._do_labels_match_scope_rules(self._matching_labels, t['Scope']) is True:
+      if self._do_labels_match_scope_rules(self._matching_labels_mask, t_masks) is True:
         
         for key in t.keys():
           if key == 'Transcode':
@@ -346,33 +400,115 @@ class DicomDeidentifier:
     
     """
     
-    def _log_t(transformation, value):
+    def _log_t(transformation, log_format, *args):
+      """
+      Record a transformation applied. The log messages are only formatted and added to the log 
+      dict by `_flush_logs` after the transformations are applied, so that the loops over data 
+      elements only append a tuple.
+      
+      """
+      _applied_logs.append((transformation, log_format, args))
+    
+    def _flush_logs():
       """
-      Add a transformation applied to the log dict.
+      Format the transformations applied and add them to the log dict.
       
       """
-      logs.setdefault('TransformationsApplied', {})
-      logs['TransformationsApplied'].setdefault(transformation, [])
-      logs['TransformationsApplied'][transformation].append(value)
+      for transformation, log_format, args in _applied_logs:
+        logs.setdefault('TransformationsApplied', {})
+        logs['TransformationsApplied'].setdefault(transformation, [])
+        logs['TransformationsApplied'][transformation].append(log_format % args)
+      _applied_logs.clear()
       
-    def _process_each_elem_item(f, elem, *args):
+    def _process_each_elem_item(f, elem, elem_value, *args):
       """
       If the element contains multiple items, process each item with the function `f`. Otherwise,
-      process its single item value with `f`. `f` returns the new value of the element item.
+      process its single item value with `f`. `f` returns a function that provides the new value 
+      of the element item, once the pending mappings are resolved. Returns a function that updates 
+      the element with the new values. `elem_value` is the value of the element, read once by the 
+      caller.
       
       """
-      if isinstance(elem.value, pydicom.multival.MultiValue):
-        for i in range(len(elem.value)):
-          elem.value[i] = f(elem, elem.value[i], *args)
+      if isinstance(elem_value, pydicom.multival.MultiValue):
+        get_new_values = [f(elem, item_value, *args) for item_value in elem_value]
+        def update_elem():
+          # Assign all new values at once rather than setting each item of the MultiValue
+          elem.value = [get_new_value() for get_new_value in get_new_values]
       else:
-        elem.value = f(elem, elem.value, *args)
+        get_new_value = f(elem, elem_value, *args)
+        def update_elem():
+          elem.value = get_new_value()
+      return update_elem
+    
+    def _request_mapping(value_type, old_value, new_value, scope_type, scope_value):
+      """
+      Add a mapping to the list of mappings to add or get from the database with the next call 
+      to `_update_elems`, and return the mapping key. The mappings are resolved in bulk to 
+      avoid one database round-trip per element item.
+      
+      """
+      key = (value_type, old_value, scope_type, scope_value)
+      if not key in _mapping_results:
+        _pending_mappings.setdefault(key, new_value)
+      return key
+    
+    def _get_mapped_value(value):
+      """
+      Return the value provided by `_get_new_value_from_mapping` once the pending mappings are 
+      resolved.
+      
+      """
+      return _mapping_results[value] if isinstance(value, tuple) else value
+    
+    def _update_elems(update_elem_functions):
+      """
+      Add or get the pending mappings from the database with a single call, and update the 
+      elements with the functions in `update_elem_functions`.
+      
+      """
+      if len(_pending_mappings) > 0:
+        keys = list(_pending_mappings.keys())
+        new_values = self._db_mapping.add_or_get_mappings([(k[0], k[1], _pending_mappings[k], k[2], k[3]) for k in keys])
+        _mapping_results.update(zip(keys, new_values))
+        _pending_mappings.clear()
+      for update_elem in update_elem_functions:
+        update_elem()
+    
+    def _get_mapping_scope(reuse_mapping):
+      """
+      Return the scope type and scope value of a mapping for a given `ReuseMapping` value. The 
+      scope does not change while the transformations are applied, since PatientID is read from 
+      `_old_patient_id` once it is randomized, and the UIDs are only randomized after the 
+      transformations that use mappings, so it is computed once per `ReuseMapping` value.
+      
+      Args:
+        reuse_mapping (str): Value of `ReuseMapping`
+        
+      """
+      if reuse_mapping == 'Always':
+        scope_type = 'always'
+        scope_value = 'always'
+      elif reuse_mapping == 'SamePatient':
+        scope_type = 'patient'
+        scope_value = _old_patient_id if _old_patient_id != None else self.dicom.PatientID
+      elif reuse_mapping == 'SameStudy':
+        scope_type = 'study'
+        scope_value = self.dicom.StudyInstanceUID
+      elif reuse_mapping == 'SameSeries':
+        scope_type = 'series'
+        scope_value = self.dicom.SeriesInstanceUID
+      else:
+        scope_type = 'study'
+        scope_value = self.dicom.SOPInstanceUID
+      if scope_value == '':
+        raise Exception('The scope value for ReuseMapping must not be empty')
+      return scope_type, scope_value
     
     def _get_new_value_from_mapping(t, value_type, old_value, new_value):
       """
-      If `ReuseMapping` is specified in `t`, check if a mapping already exists in the database, 
-      and return the existing value in that case. Otherwise, create a new mapping in the database 
-      between `old_value` and `new_value` if `ReuseMapping` is specified, and return the new 
-      value.
+      If `ReuseMapping` is specified in `t`, request a mapping between `old_value` and 
+      `new_value` from the database and return its key. Otherwise, return `new_value`. In both 
+      cases, the final value is provided by `_get_mapped_value` after `_update_elems` is called.
       
       Args:
         t: dict that may contain a `ReuseMapping` attribute
@@ -382,78 +518,100 @@ class DicomDeidentifier:
         
       """
       if 'ReuseMapping' in t:
-        if t['ReuseMapping'] == 'Always':
-          scope_type = 'always'
-          scope_value = 'always'
-        elif t['ReuseMapping'] == 'SamePatient':
-          scope_type = 'patient'
-          scope_value = _old_patient_id if _old_patient_id != None else self.dicom.PatientID
-        elif t['ReuseMapping'] == 'SameStudy':
-          scope_type = 'study'
-          scope_value = self.dicom.StudyInstanceUID
-        elif t['ReuseMapping'] == 'SameSeries':
-          scope_type = 'series'
-          scope_value = self.dicom.SeriesInstanceUID
-        else:
-          scope_type = 'study'
-          scope_value = self.dicom.SOPInstanceUID
-        if scope_value == '':
-          raise Exception('The scope value for ReuseMapping must not be empty')
-        return self._db_mapping.add_or_get_mapping(value_type, old_value, new_value, scope_type, scope_value)
+        if not t['ReuseMapping'] in _mapping_scopes:
+          _mapping_scopes[t['ReuseMapping']] = _get_mapping_scope(t['ReuseMapping'])
+        scope_type, scope_value = _mapping_scopes[t['ReuseMapping']]
+        return _request_mapping(value_type, old_value, new_value, scope_type, scope_value)
       else:
         return new_value
       
     dst_transfer_syntax = self._src_transfer_syntax
     _last_action = ''  # This is used for debugging if an exception is raised
     _old_patient_id = None  # Keep track of the initial PatientID value if it is changed
+    _pending_mappings = {}  # Mappings to add or get from the database with the next bulk query
+    _mapping_results = {}  # Mappings already added or retrieved from the database
+    _mapping_scopes = {}  # Scope type and value for each `ReuseMapping` value
+    _applied_logs = []  # Transformations applied, formatted by `_flush_logs`
     try:
       
+      # ShiftDateTime, RandomizeText and RandomizeUID only alter the value of data elements. The 
+      # elements that match each of these transformations are found with a single walk through 
+      # the dataset, instead of one walk per transformation, and the transformations are then 
+      # applied in the same order as before. ShiftDateTime and RandomizeUID are left out of the 
+      # walk if the DICOM file contains no data element with a VR they can alter. The VRs are only 
+      # listed if one of these transformations must be applied
+      _last_action = 'MatchTagPatterns'
+      value_t_types = ['RandomizeText']
+      if len(self._transformations.get('ShiftDateTime', [])) > 0 or len(self._transformations.get('RandomizeUID', [])) > 0:
+        vrs_present = {elem.VR for elem in self.dicom.iterall()}
+        if not vrs_present.isdisjoint(('DA', 'DT', 'TM')):
+          value_t_types.insert(0, 'ShiftDateTime')
+        if 'UI' in vrs_present:
+          value_t_types.append('RandomizeUID')
+      value_transformations = [
+        (t_type, t) for t_type in value_t_types
+        for t in self._transformations.get(t_type, [])
+      ]
+      matched_elems = [[] for i in value_transformations]
+      if len(value_transformations) > 0:
+        rules = [(t['TagPatterns'], t['ExceptTagPatterns']) for t_type, t in value_transformations]
+        for elem, elem_full_tag, parent_elem, i_rules in dicom_tpp.enumerate_elements_match_tag_path_pattern_rules(self.dicom, rules):
+          for i_rule in i_rules:
+            matched_elems[i_rule].append((elem, elem_full_tag))
+      
+      def _enumerate_matched_elems(t_type):
+        """
+        Enumerate (transformation, list of (data element, full tag)) for each transformation of 
+        type `t_type`.
+        
+        """
+        for (i_t_type, t), elems in zip(value_transformations, matched_elems):
+          if i_t_type == t_type:
+            yield t, elems
+      
+      # For each transformation, the new values of all matching elements are computed first, 
+      # then the mappings are added or retrieved from the database with a single query, and the 
+      # elements are finally updated
+      
       ### ShiftDateTime
       if 'ShiftDateTime' in self._transformations:
         _last_action = f'ShiftDateTime'
         
-        def shift_date_time(elem, item_value, elem_full_tag, t):
+        def shift_date_time(elem, elem_value, vr, elem_full_tag, t):
           """
-          Converts the string value to a datetime object and shift by `ShiftBy` days if it is a 
-          DA, or `ShiftBy` seconds if it a DT or TM.
+          Shift all the values of the element by a random number of days between `-ShiftBy` and 
+          `ShiftBy` if it is a DA, or a random number of seconds if it is a DT or TM. The values 
+          are parsed and shifted together with `_shift_date_time_values`. Returns a function that 
+          updates the element.
           
           Args:
             elem: pydicom DataElement
-            elem_value (str): Value of the element item to process
+            elem_value: Value of the element
+            vr (str): VR of the element
             elem_full_tag (str): Full path to the element
             t: dict for the current transformation
             
           """
-          old_value = str(item_value)
-          shift_value = random.randint(-t['ShiftBy'], +t['ShiftBy'])
+          is_multi_value = isinstance(elem_value, pydicom.multival.MultiValue)
+          old_values = [str(i) for i in elem_value] if is_multi_value else [str(elem_value)]
+          new_values = _shift_date_time_values(old_values, vr, t['ShiftBy'])
+          new_values = [_get_new_value_from_mapping(t, 'DATETIME', old, new) for old, new in zip(old_values, new_values)]
           
-          # If VR is DA, shift the date by `shift_value` days
-          if elem.VR == 'DA':
-            old_date = datetime.datetime.strptime(old_value, '%Y%m%d')
-            new_date = old_date + datetime.timedelta(days=shift_value)
-            new_value = new_date.strftime('%Y%m%d')
-            
-          # If VR is TM, shift the date by `shift_value` seconds
-          elif elem.VR == 'TM':
-            old_date = datetime.datetime.strptime(old_value[:6], '%H%M%S')
-            new_date = old_date + datetime.timedelta(seconds=shift_value)
-            new_value = new_date.strftime('%H%M%S')
-            
-          # If VR is DT, shift the date by `shift_valxue` seconds
-          else:
-            old_date = datetime.datetime.strptime(old_value[:14], '%Y%m%d%H%M%S')
-            new_date = old_date + datetime.timedelta(seconds=shift_value)
-            new_value = new_date.strftime('%Y%m%d%H%M%S')
-          
-          final_value = _get_new_value_from_mapping(t, 'DATETIME', old_value, new_value)
-          _log_t('ShiftDateTime', f"Tag={elem_full_tag} OldValue={old_value} NewValue={final_value}")
-          return final_value
+          def update_elem():
+            final_values = [_get_mapped_value(i) for i in new_values]
+            for old_value, final_value in zip(old_values, final_values):
+              _log_t('ShiftDateTime', 'Tag=%s OldValue=%s NewValue=%s', elem_full_tag, old_value, final_value)
+            elem.value = final_values if is_multi_value else final_values[0]
+          return update_elem
           
-        for t in self._transformations['ShiftDateTime']:
-          for elem, elem_full_tag, parent_elem in dicom_tpp.enumerate_elements_match_tag_path_patterns(self.dicom, t['TagPatterns'], t['ExceptTagPatterns']):
+        for t, elems in _enumerate_matched_elems('ShiftDateTime'):
+          update_elem_functions = []
+          for elem, elem_full_tag in elems:
             _last_action = f'ShiftDateTime Tag={elem_full_tag}'
-            if elem.VR in ('DA', 'DT', 'TM') and not elem.is_empty:
-              _process_each_elem_item(shift_date_time, elem, elem_full_tag, t)
+            vr = elem.VR
+            if vr in ('DA', 'DT', 'TM') and not elem.is_empty:
+              update_elem_functions.append(shift_date_time(elem, elem.value, vr, elem_full_tag, t))
+          _update_elems(update_elem_functions)
       
       ### RandomizeText
       if 'RandomizeText' in self._transformations:
@@ -466,14 +624,16 @@ class DicomDeidentifier:
           
           Args:
             elem: pydicom DataElement
-            elem_i (int): If elem contains multiple values, `elem_i` is the index of the value to 
-              process. If there is a single value, `elem_i ` equals `None`
+            item_value (str): Value of the element item to process
             elem_full_tag (str): Full path to the element
             t: dict for the current transformation
             
           """
+          # `Split` is None if it is not specified. An empty separator is ignored, since 
+          # `str.split` does not accept it
+          do_split = t['Split'] != None and t['Split'] != ''
           old_value_before_split = str(item_value)
-          old_value_after_split = old_value_before_split.split(t['Split']) if t['Split'] is True else [str(old_value_before_split)]
+          old_value_after_split = old_value_before_split.split(t['Split']) if do_split else (old_value_before_split,)
           new_value_before_join = []
           
           for old_value in old_value_after_split:
@@ -481,21 +641,27 @@ class DicomDeidentifier:
               new_value = ''
             else:
               old_value = old_value.lower() if t['IgnoreCase'] is True else old_value
-              random_value = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(8))
+              random_value = ''.join(random.choices(_RANDOM_TEXT_ALPHABET, k=8))
               new_value = _get_new_value_from_mapping(t, 'DATETIME', old_value, random_value)
             new_value_before_join.append(new_value)
           
-          final_value = t['Split'].join(new_value_before_join) if t['Split'] is True else new_value_before_join[0]
-          _log_t('RandomizeText', f"Tag={elem_full_tag} OldValue={old_value_before_split} NewValue={final_value}")
-          return final_value
+          def get_new_value():
+            final_values = [_get_mapped_value(i) for i in new_value_before_join]
+            final_value = t['Split'].join(final_values) if do_split else final_values[0]
+            _log_t('RandomizeText', 'Tag=%s OldValue=%s NewValue=%s', elem_full_tag, old_value_before_split, final_value)
+            return final_value
+          return get_new_value
         
-        for t in self._transformations['RandomizeText']:
-          for elem, elem_full_tag, parent_elem in dicom_tpp.enumerate_elements_match_tag_path_patterns(self.dicom, t['TagPatterns'], t['ExceptTagPatterns']):
+        for t, elems in _enumerate_matched_elems('RandomizeText'):
+          update_elem_functions = []
+          for elem, elem_full_tag in elems:
             _last_action = f'RandomizeText Tag={elem_full_tag}'
             if not elem.is_empty:
+              elem_value = elem.value
               if elem_full_tag == '00100020':
-                _old_patient_id = elem.value
-              _process_each_elem_item(randomize_text, elem, elem_full_tag, t)
+                _old_patient_id = elem_value
+              update_elem_functions.append(_process_each_elem_item(randomize_text, elem, elem_value, elem_full_tag, t))
+          _update_elems(update_elem_functions)
       
       ### RandomizeUID
       if 'RandomizeUID' in self._transformations:
@@ -508,28 +674,33 @@ class DicomDeidentifier:
           
           Args:
             elem: pydicom DataElement
-            elem_i (int): If elem contains multiple values, `elem_i` is the index of the value to 
-              process. If there is a single value, `elem_i ` equals `None`
+            item_value (str): Value of the element item to process
             elem_full_tag (str): Full path to the element
             t: dict for the current transformation
             
           """
           old_uid = str(item_value)
-          random_uid = pydicom.uid.generate_uid(prefix=t['Prefix']) if 'Prefix' in t else pydicom.uid.generate_uid()
-          new_uid = self._db_mapping.add_or_get_mapping('UID', old_uid, random_uid, 'always', 'always')
-          # Update the tag value, and the meta header tag MediaStorageSOPInstanceUID if the 
-          # current element is SOPInstanceUID
-          if elem_full_tag == '00080018':
-            self.dicom.file_meta.MediaStorageSOPInstanceUID = new_uid
-          _log_t('RandomizeUID', f"Tag={elem_full_tag} OldValue={old_uid} NewValue={new_uid}")
-          return new_uid
+          random_uid = _generate_uid(t['Prefix'] if 'Prefix' in t else pydicom.uid.PYDICOM_ROOT_UID)
+          mapping_key = _request_mapping('UID', old_uid, random_uid, 'always', 'always')
+          
+          def get_new_value():
+            new_uid = _get_mapped_value(mapping_key)
+            # Update the tag value, and the meta header tag MediaStorageSOPInstanceUID if the 
+            # current element is SOPInstanceUID
+            if elem_full_tag == '00080018':
+              self.dicom.file_meta.MediaStorageSOPInstanceUID = new_uid
+            _log_t('RandomizeUID', 'Tag=%s OldValue=%s NewValue=%s', elem_full_tag, old_uid, new_uid)
+            return new_uid
+          return get_new_value
         
-        for t in self._transformations['RandomizeUID']:
-          for elem, elem_full_tag, parent_elem in dicom_tpp.enumerate_elements_match_tag_path_patterns(self.dicom, t['TagPatterns'], t['ExceptTagPatterns']):
+        for t, elems in _enumerate_matched_elems('RandomizeUID'):
+          update_elem_functions = []
+          for elem, elem_full_tag in elems:
             _last_action = f'RandomizeUID Tag={elem_full_tag}'
             # Ignore the element if its VR is not UI
             if elem.VR == 'UI' and not elem.is_empty:
-              _process_each_elem_item(randomize_uid, elem, elem_full_tag, t)
+              update_elem_functions.append(_process_each_elem_item(randomize_uid, elem, elem.value, elem_full_tag, t))
+          _update_elems(update_elem_functions)
       
       ### AddTags
       if 'AddTags' in self._transformations:
@@ -541,80 +712,97 @@ class DicomDeidentifier:
               continue
             new_elem = pydicom.dataelem.DataElement(tag_int, t['VR'], t['Value'])
             parent_elem.add(new_elem)
-          _log_t('AddTags', f"Tag={t['Tag']}")
+          _log_t('AddTags', 'Tag=%s', t['Tag'])
 
       ## RemoveBurnedInAnnotations
-      if 'RemoveBurnedInAnnotations' in self._transformations:
+      # The pixel data is only decoded if there is at least one box to obscure
+      if 'RemoveBurnedInAnnotations' in self._transformations and any(len(t.get('BoxCoordinates', [])) > 0 for t in self._transformations['RemoveBurnedInAnnotations']):
         _last_action = f'RemoveBurnedInAnnotations'
-        pixels = self.dicom.pixel_array
         width, height = rpacs_dicom_util.get_dimensions(self.dicom)
         samples_per_pixel = rpacs_dicom_util.get_samples_per_pixel(self.dicom)
-        _last_action = f'RemoveBurnedInAnnotations Step=CreateMask PixelArrayShape={pixels.shape} Width={width} Height={height} SamplesPerPixel={samples_per_pixel}'
         
-        # Generate a mask that will be used to replace boxes to mask with black pixels. The mask 
-        # contains only "1" values first, and will be set to "0" later for pixels to obscur
-        if pixels.ndim == 4:
-          # (frames, Y, X, channel)
-          mask = np.ones((1, height, width, 1), dtype=np.uint8)
-        elif pixels.ndim == 3 and pixels.shape[2] == samples_per_pixel:
-          # (Y, X, channel)
-          mask = np.ones((height, width, 1), dtype=np.uint8)
-        elif pixels.ndim == 3:
-          # (frames, Y, X)
-          mask = np.ones((1, height, width), dtype=np.uint8)
-        else:
-          # (Y, X)
-          mask = np.ones((height, width), dtype=np.uint8)
+        # Stack the boxes of all transformations in a (N, 4) array and clip the coordinates to 
+        # the image dimensions
+        _last_action = f'RemoveBurnedInAnnotations Step=ClipBoxes Width={width} Height={height}'
+        typed_boxes = [(t['Type'], box) for t in self._transformations['RemoveBurnedInAnnotations'] for box in t.get('BoxCoordinates', [])]
+        boxes = np.array([box for box_type, box in typed_boxes], dtype=np.int64).reshape(-1, 4)
+        np.clip(boxes, 0, np.array([width-1, height-1, width-1, height-1]), out=boxes)
+        for (box_type, box), (box_left, box_top, box_right, box_bottom) in zip(typed_boxes, boxes.tolist()):
+          _log_t('RemoveBurnedInAnnotations', 'Type=%s Box=(%s, %s, %s, %s)', box_type, box_left, box_top, box_right, box_bottom)
         
-        for t in self._transformations['RemoveBurnedInAnnotations']:
-          if 'BoxCoordinates' in t:
-            for box in t['BoxCoordinates']:
-              box_left, box_top, box_right, box_bottom = box
-              _last_action = f'RemoveBurnedInAnnotations Step=EditMask PixelArrayShape={pixels.shape} MaskShape={mask.shape} Box=({box_left}, {box_top}, {box_right}, {box_bottom})'
-              box_left = max(0, min(width-1, box_left))
-              box_right = max(0, min(width-1, box_right))
-              box_top = max(0, min(height-1, box_top))
-              box_bottom = max(0, min(height-1, box_bottom))
-              # Put zeros in the mask where pixels must be obscured
-              if pixels.ndim == 4:
-                mask[0, box_top:box_bottom, box_left:box_right, 0] = 0
-              elif pixels.ndim == 3 and pixels.shape[2] == samples_per_pixel:
-                mask[box_top:box_bottom, box_left:box_right, 0] = 0
-              elif pixels.ndim == 3:
-                mask[0, box_top:box_bottom, box_left:box_right] = 0
-              else:
-                mask[box_top:box_bottom, box_left:box_right] = 0
-              _log_t('RemoveBurnedInAnnotations', f"Type={t['Type']} Box=({box_left}, {box_top}, {box_right}, {box_bottom})")
+        # Boxes that are empty once clipped, for example if they are outside the image, do not 
+        # change any pixel. The pixel data is not decoded nor re-encoded if all boxes are empty
+        boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+        if len(boxes) > 0:
+          pixels = self.dicom.pixel_array
+          
+          # The boxes are zeroed in place, so the pixel array must be writeable. It must also be 
+          # C-contiguous so that it can be converted to bytes without a strided copy
+          if not pixels.flags.writeable or not pixels.flags.c_contiguous:
+            pixels = np.array(pixels, order='C')
         
-        # Apply the mask and updated the DICOM image tags accordingly
-        _last_action = f'RemoveBurnedInAnnotations Step=ApplyMask PixelArrayShape={pixels.shape} MaskShape={mask.shape}'
-        new_pixels = mask * pixels
-        self.dicom.PixelData = new_pixels.tobytes()
-        self.dicom.BitsAllocated = pixels.itemsize*8
-        self.dicom.BitsStored = pixels.itemsize*8
-        self.dicom.HighBit = pixels.itemsize*8-1
-        if samples_per_pixel > 1:
-          self.dicom.PlanarConfiguration = 0
+          # Generate a mask that contains `True` for pixels to obscur. Instead of editing the mask 
+          # for each box, each box adds +1/-1 at its corners in a 2D difference array, whose 
+          # cumulative sums are non-zero inside the boxes. The corners of all boxes are added with 
+          # a single scatter operation: (top, left), (top, right), (bottom, left), (bottom, right)
+          _last_action = f'RemoveBurnedInAnnotations Step=CreateMask PixelArrayShape={pixels.shape} Width={width} Height={height} SamplesPerPixel={samples_per_pixel}'
+          corners = np.zeros((height+1, width+1), dtype=np.int32)
+          corner_rows = boxes[:, [1, 1, 3, 3]].ravel()
+          corner_cols = boxes[:, [0, 2, 0, 2]].ravel()
+          corner_signs = np.tile(np.array([1, -1, -1, 1], dtype=np.int32), len(boxes))
+          np.add.at(corners, (corner_rows, corner_cols), corner_signs)
+          mask = corners.cumsum(axis=0).cumsum(axis=1)[:height, :width] != 0
+        
+          # Replace the pixels to obscur with black pixels directly in the pixel array, rather 
+          # than multiplying the whole pixel array by a mask
+          _last_action = f'RemoveBurnedInAnnotations Step=ApplyMask PixelArrayShape={pixels.shape} MaskShape={mask.shape}'
+          if pixels.ndim == 4 or (pixels.ndim == 3 and pixels.shape[2] != samples_per_pixel):
+            # (frames, Y, X, channel) or (frames, Y, X)
+            pixels[:, mask] = 0
+          else:
+            # (Y, X, channel) or (Y, X)
+            pixels[mask] = 0
+          self.dicom.PixelData = pixels.tobytes()
+      
+          # Update the DICOM image tags accordingly, if their value changed
+          bits = pixels.itemsize*8
+          image_tags = {'BitsAllocated': bits, 'BitsStored': bits, 'HighBit': bits-1}
+          if samples_per_pixel > 1:
+            image_tags['PlanarConfiguration'] = 0
+          for keyword, value in image_tags.items():
+            if self.dicom.get(keyword) != value:
+              setattr(self.dicom, keyword, value)
       
       ### DeleteTags
+      # The data elements matching the transformations are enumerated with a single walk through 
+      # the dataset. The transformations that match a data element are applied in order, until 
+      # one removes the data element
       if 'DeleteTags' in self._transformations:
         _last_action = 'DeleteTags'
-        for t in self._transformations['DeleteTags']:
-          for elem, elem_full_tag, parent_elem in dicom_tpp.enumerate_elements_match_tag_path_patterns(self.dicom, t['TagPatterns'], t['ExceptTagPatterns']):
-            _last_action = f'DeleteTags Tag={elem_full_tag}'
-            if t['Action'] == 'Remove':
+        delete_transformations = self._transformations['DeleteTags']
+        rules = [(t['TagPatterns'], t['ExceptTagPatterns']) for t in delete_transformations]
+        for elem, elem_full_tag, parent_elem, i_rules in dicom_tpp.enumerate_elements_match_tag_path_pattern_rules(self.dicom, rules):
+          _last_action = f'DeleteTags Tag={elem_full_tag}'
+          for i_rule in i_rules:
+            action = delete_transformations[i_rule]['Action']
+            _log_t('DeleteTags', 'Tag=%s Action=%s', elem_full_tag, action)
+            if action == 'Remove':
               del parent_elem[elem.tag]
+              break
             else:
               elem.clear()
-            _log_t('DeleteTags', f"Tag={elem_full_tag} Action={t['Action']}")
       
       ### Transcode
       if 'Transcode' in self._transformations:
         dst_transfer_syntax = self._transformations['Transcode']
-        _log_t('Transcode', f"{dst_transfer_syntax}")
+        _log_t('Transcode', '%s', dst_transfer_syntax)
   
     except Exception as e:
       raise Exception(f'Last action attempted: {_last_action} - {e}')
+    
+    # Add the transformations applied to the log dict, even if a transformation failed
+    finally:
+      _flush_logs()
   
     # Check if the current DICOM file in `self.dicom` should be transcoded to a new transfer 
     # syntax and return the new transfer syntax and the list of changes applied
@@ -669,70 +857,183 @@ class DicomDeidentifier:
     Generate the list of labels that match the current DICOM instance.
     
     """
-    matching_labels = ['ALL']
-    dicom_json = rpacs_dicom_json.convert_dicom_to_json(self.dicom)
-    for label in self._config['Labels']:
-      logger.debug(f"Checking whether the DICOM file matches the label \"{label['Name']}\"")
+    # Labels automatically match if there is no filtering query
+    labels = self._config['Labels']
+    label_matches = [not 'JSONPathQuery' in label for label in labels]
+    labels_with_query = [i_label for i_label, label in enumerate(labels) if 'JSONPathQuery' in label]
+    
+    # If filtering queries are specified, query the PostgreSQL database once to check if the DICOM 
+    # instance matches each resulting JSONPath query. The DICOM instance is converted to a JSON 
+    # document and sent only once, and the queries are sent as an array. The query returns the 
+    # positions (starting from 1) of the queries that match
+    if len(labels_with_query) > 0:
+      logger.debug(f"Checking whether the DICOM file matches the labels {[labels[i_label]['Name'] for i_label in labels_with_query]}")
+      dicom_json = rpacs_dicom_json.convert_dicom_to_json(self.dicom)
+      arg_dicom = orjson.dumps(dicom_json).decode()
+      arg_queries = [f"$ ? ({labels[i_label]['JSONPathQuery']})" for i_label in labels_with_query]
       try:
-        
-        # The label automatically matches if there is no filtering query
-        if not 'JSONPathQuery' in label:
-          matching_labels.append(label['Name'])
-          
-        # If a filtering query is specified, query the PostgreSQL database to check if the DICOM 
-        # instance match the resulting JSONPath query
-        else:
-          arg_dicom = json.dumps(dicom_json)
-          arg_query = f"$ ? ({label['JSONPathQuery']})"
-          self._db.execute(f"SELECT jsonb %s @? %s;", (arg_dicom, arg_query))
-          if self._db.fetchone()[0] == True:
-            matching_labels.append(label['Name'])
-            
+        self._db.execute(
+          "WITH t AS (SELECT %s::jsonb AS dicom) "
+          "SELECT array_agg(q.idx) FROM t, unnest(%s::text[]) WITH ORDINALITY AS q(query, idx) "
+          "WHERE t.dicom @? q.query::jsonpath;",
+          (arg_dicom, arg_queries)
+        )
+        matching_positions = self._db.fetchone()[0]
+      
+      # If the query failed, check each label separately to find which label failed
       except Exception as e:
-        raise Exception(f"Failed to check if the DICOM file matches the label \"{label['Name']}\" - {e}")
+        for i_label, arg_query in zip(labels_with_query, arg_queries):
+          try:
+            self._db.execute(f"SELECT jsonb %s @? %s;", (arg_dicom, arg_query))
+          except Exception as e_label:
+            raise Exception(f"Failed to check if the DICOM file matches the label \"{labels[i_label]['Name']}\" - {e_label}")
+        raise Exception(f'Failed to check if the DICOM file matches the labels - {e}')
+      
+      if matching_positions != None:
+        for position in matching_positions:
+          label_matches[labels_with_query[position-1]] = True
+    
+    matching_labels = ['ALL'] + [label['Name'] for label, label_match in zip(labels, label_matches) if label_match is True]
     return matching_labels
 
 
-  def _do_labels_match_scope_rules(self, labels, rules):
+  def _compile_scope_rules(self):
     """
-    Evaluate whether one of the labels in `labels` match the included labels defined by the rules 
-    in `rules`, and not with the excluded labels.
-    
-    Args:
-      labels (list): List of labels
-      rules (dict): Dict that can contain `Labels`, `ExceptLabels`, `Categories`, `ExceptCategories` 
-        attributes
+    Assign a bit to each label, and compile the scope rules of "ScopeToForward" and of each 
+    transformation into a tuple (included labels mask, excluded labels mask). This allows to 
+    evaluate the scope rules with bitwise operations for each DICOM file. Returns a tuple (dict 
+    of label bits, masks for "ScopeToForward", list of masks for each transformation).
     
     """
-    included_labels = []
-    excluded_labels = []
-    
-    if 'Labels' in rules:
-      included_labels += rules['Labels']
-    if 'Categories' in rules:
-      for category in rules['Categories']:
-        included_labels += self._get_labels_for_category(category)
-    if 'ExceptLabels' in rules:
-      excluded_labels += rules['ExceptLabels']
-    if 'ExceptCategories' in rules:
-      for category in rules['ExceptCategories']:
-        excluded_labels += self._get_labels_for_category(category)
-
-    for label in labels:
-      if label in excluded_labels:
-        return False
-    for label in labels:
-      if label in included_labels:
-        return True
-    return False
-
-
-  def _get_labels_for_category(self, category_name):
+    label_bits = {}
+    
+    # Index the labels of each category by category name
+    category_labels = {category['Name']: tuple(category['Labels']) for category in self._config.get('Categories', [])}
+    
+    def get_labels_mask(labels):
+      mask = 0
+      for label in labels:
+        if not label in label_bits:
+          label_bits[label] = 1 << len(label_bits)
+        mask |= label_bits[label]
+      return mask
+    
+    # Labels that are listed several times, directly or through categories, are only added once 
+    # to the mask
+    def compile_rules(rules):
+      included_labels = set(rules.get('Labels', []))
+      excluded_labels = set(rules.get('ExceptLabels', []))
+      for category in rules.get('Categories', []):
+        included_labels.update(category_labels[category])
+      for category in rules.get('ExceptCategories', []):
+        excluded_labels.update(category_labels[category])
+      return get_labels_mask(sorted(included_labels)), get_labels_mask(sorted(excluded_labels))
+    
+    get_labels_mask(['ALL'] + [label['Name'] for label in self._config['Labels']])
+    forward_masks = compile_rules(self._config['ScopeToForward'])
+    transformation_masks = [compile_rules(t['Scope']) for t in self._config['Transformations']]
+    return label_bits, forward_masks, transformation_masks
+
+
+  def _do_labels_match_scope_rules(self, labels_mask, rule_masks):
     """
-    Return the list of labels associated with a given category, as defined in the "Categories" 
-    attribute of the config file.
+    Evaluate whether one of the labels in `labels_mask` match the included labels defined by the 
+    rules, and not with the excluded labels.
+    
+    Args:
+      labels_mask (int): Bit mask of the labels
+      rule_masks (tuple): Tuple (included labels mask, excluded labels mask) generated by 
+        `_compile_scope_rules`
     
     """
-    for category in self._config['Categories']:
-      if category['Name'] == category_name:
-        return category['Labels']
+    included_mask, excluded_mask = rule_masks
+    return labels_mask & excluded_mask == 0 and labels_mask & included_mask != 0
+
+
+def _shift_date_time_values(values, vr, shift_by):
+  """
+  Shift a list of DA, DT or TM values by a random number of days (DA) or seconds (DT and TM) 
+  between `-shift_by` and `shift_by`. Each value is shifted by a different random number. The 
+  values are parsed, shifted and formatted with NumPy in a single pass rather than one value at 
+  a time. DT values are truncated to the second and TM values wrap around midnight.
+  
+  Args:
+    values (list): List of DA, DT or TM values
+    vr (str): Value representation (DA, DT or TM)
+    shift_by (int): Maximum number of days or seconds to shift
+  
+  """
+  # For single-valued elements, which are the most common, parsing the fixed-width value with 
+  # integer slicing is faster than creating NumPy arrays
+  if len(values) == 1:
+    return [_shift_date_time_value(values[0], vr, random.randint(-shift_by, shift_by))]
+  
+  shift_values = np.random.randint(-shift_by, shift_by + 1, size=len(values))
+  
+  # If VR is DA, shift the dates by `shift_values` days
+  if vr == 'DA':
+    old_dates = np.array([f'{v[:4]}-{v[4:6]}-{v[6:8]}' for v in values], dtype='datetime64[D]')
+    new_dates = old_dates + shift_values.astype('timedelta64[D]')
+    return [i.replace('-', '') for i in np.datetime_as_string(new_dates, unit='D')]
+  
+  # If VR is TM, shift the times by `shift_values` seconds
+  elif vr == 'TM':
+    old_times = np.array([[v[0:2], v[2:4], v[4:6]] for v in values], dtype=np.int64)
+    if np.any(old_times[:, 0] > 23) or np.any(old_times[:, 1:] > 59):
+      raise ValueError(f'Invalid TM value in {values}')
+    old_secs = old_times[:, 0] * 3600 + old_times[:, 1] * 60 + old_times[:, 2]
+    new_secs = (old_secs + shift_values) % 86400
+    return [f'{s // 3600:02d}{s // 60 % 60:02d}{s % 60:02d}' for s in new_secs.tolist()]
+  
+  # If VR is DT, shift the dates by `shift_values` seconds
+  else:
+    old_dates = np.array([f'{v[:4]}-{v[4:6]}-{v[6:8]}T{v[8:10]}:{v[10:12]}:{v[12:14]}' for v in values], dtype='datetime64[s]')
+    new_dates = old_dates + shift_values.astype('timedelta64[s]')
+    return [i.replace('-', '').replace('T', '').replace(':', '') for i in np.datetime_as_string(new_dates, unit='s')]
+
+
+def _generate_uid(prefix):
+  """
+  Generate a new UID that starts with `prefix`. Fall back to `pydicom.uid.generate_uid` if the 
+  UID would be longer than 64 characters.
+  
+  Args:
+    prefix (str): UID prefix, which should end with a dot
+  
+  """
+  uid = f'{prefix}{_uid_process_id}.{next(_uid_counter)}'
+  if len(uid) > 64:
+    return pydicom.uid.generate_uid(prefix=prefix)
+  return uid
+
+
+def _shift_date_time_value(value, vr, shift_value):
+  """
+  Shift a single DA, DT or TM value by `shift_value` days (DA) or seconds (DT and TM). The value 
+  is parsed with integer slicing, since DA, DT and TM values have fixed-width components.
+  
+  Args:
+    value (str): DA, DT or TM value
+    vr (str): Value representation (DA, DT or TM)
+    shift_value (int): Number of days or seconds to shift
+  
+  """
+  # If VR is DA, shift the date by `shift_value` days
+  if vr == 'DA':
+    new_date = datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8])) + datetime.timedelta(days=shift_value)
+    return f'{new_date.year:04d}{new_date.month:02d}{new_date.day:02d}'
+  
+  # If VR is TM, shift the time by `shift_value` seconds
+  elif vr == 'TM':
+    hours, minutes, seconds = int(value[0:2]), int(value[2:4]), int(value[4:6])
+    if hours > 23 or minutes > 59 or seconds > 59:
+      raise ValueError(f'Invalid TM value {value}')
+    new_secs = (hours * 3600 + minutes * 60 + seconds + shift_value) % 86400
+    return f'{new_secs // 3600:02d}{new_secs // 60 % 60:02d}{new_secs % 60:02d}'
+  
+  # If VR is DT, shift the date by `shift_value` seconds
+  else:
+    new_date = datetime.datetime(
+      int(value[0:4]), int(value[4:6]), int(value[6:8]), int(value[8:10]), int(value[10:12]), int(value[12:14])
+    ) + datetime.timedelta(seconds=shift_value)
+    return f'{new_date.year:04d}{new_date.month:02d}{new_date.day:02d}{new_date.hour:02d}{new_date.minute:02d}{new_date.second:02d}'
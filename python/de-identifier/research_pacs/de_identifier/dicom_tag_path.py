@@ -1,6 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import functools
 import re
 
 import pydicom
@@ -9,6 +10,10 @@ import pydicom
 TAG_PATH_KEYWORD = '([A-Za-z0-9]+)(?:\[(\d+|%)\])?'
 TAG_PATH_NUMBER = '([0-9A-F]{8})(?:\[(\d+|%)\])?'
 
+# Compiled versions of the regular expressions above
+_RE_TAG_PATH_KEYWORD = re.compile(TAG_PATH_KEYWORD)
+_RE_TAG_PATH_NUMBER = re.compile(TAG_PATH_NUMBER)
+
 """
 A valid tag path is composed of tag separated by ".". Each tag can either be a keyword, or a 
 8 hexadecimal-digit. It can optionally ends with an item-number `[x]` (x is a number of `@`
@@ -33,7 +38,7 @@ def is_tag_path(tag_path):
   
   """
   for tag in tag_path.split('.'):
-    if not (re.fullmatch(TAG_PATH_KEYWORD, tag) or re.fullmatch(TAG_PATH_NUMBER, tag)):
+    if not (_RE_TAG_PATH_KEYWORD.fullmatch(tag) or _RE_TAG_PATH_NUMBER.fullmatch(tag)):
       return False
   return True
 
@@ -49,39 +54,49 @@ def enumerate_parent_elements(ds, tag_path):
     
   """
   tag_path_split = tag_path.split('.')
-  tag = tag_path_split[0]
-  tag_int, value_index = _parse_tag(tag)
+  last_depth = len(tag_path_split) - 1
   
-  # If this is the last element of the tag path
-  if len(tag_path_split) == 1:
-    yield ds, tag_int
+  # Walk through the datasets with an explicit stack of (dataset, depth in the tag path). Sequence 
+  # items are pushed in reverse order so that they are processed in the same order as they 
+  # appear in the sequence
+  stack = [(ds, 0)]
+  while len(stack) > 0:
+    ds, depth = stack.pop()
+    tag = tag_path_split[depth]
+    tag_int, value_index = _parse_tag(tag)
+    
+    # If this is the last element of the tag path
+    if depth == last_depth:
+      yield ds, tag_int
+      continue
     
-  else:
     if not tag_int in ds:
       raise Exception(f'The tag "{tag}" does not exist in the tag path')
     
     # The intermediate data elements must be a Sequence
     elem = ds[tag_int]
     if elem.VR != 'SQ':
-      raise Exception('The tag "{tag}" must be a sequence')
+      raise Exception(f'The tag "{tag}" must be a sequence')
 
     # Iterate on each sequence item, according to what the item-number defined in the tag path
     items_range = range(len(elem.value)) if (value_index == '%' or value_index is None) else [int(value_index)]
-    for i in items_range:
-      yield from enumerate_parent_elements(elem.value[i], '.'.join(tag_path_split[1:]))
+    for i in reversed(items_range):
+      stack.append((elem.value[i], depth+1))
 
     
+@functools.lru_cache(maxsize=4096)
 def _parse_tag(tag):
   """
   Returns the tag hexadecimal number and the item-number index if it is provided, or `None` if not.
+  The result is cached since the same tags are parsed for each sequence item and each DICOM file.
   
   """
-  match = re.fullmatch(TAG_PATH_NUMBER, tag)
+  match = _RE_TAG_PATH_NUMBER.fullmatch(tag)
   if match:
     tag_int = int(match.group(1), 16)
     return tag_int, match.group(2)
     
-  match = re.fullmatch(TAG_PATH_KEYWORD, tag)
+  match = _RE_TAG_PATH_KEYWORD.fullmatch(tag)
   if match:
     tag_int = pydicom.datadict.tag_for_keyword(match.group(1))
     if tag_int:
@@ -1,6 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import functools
 import re
 
 
@@ -9,6 +10,12 @@ TAG_PATH_PATERN_NUMBER = '[0-9A-FX@]{8}'
 TAG_PATH_PATTERN_PRIVATE_CREATOR = '[0-9A-FX@]{4}\{[^\}]+\}[0-9A-FX@]{2}'
 TAG_PATH_PATTERN_VR = '\{[A-Z]{2}\}'
 
+# Compiled versions of the regular expressions above
+_RE_TAG_PATH_PATTERN_KEYWORD = re.compile(TAG_PATH_PATTERN_KEYWORD)
+_RE_TAG_PATH_PATERN_NUMBER = re.compile(TAG_PATH_PATERN_NUMBER)
+_RE_TAG_PATH_PATTERN_PRIVATE_CREATOR = re.compile(TAG_PATH_PATTERN_PRIVATE_CREATOR)
+_RE_TAG_PATH_PATTERN_VR = re.compile(TAG_PATH_PATTERN_VR)
+
 """
 A valid tag path pattern:
 - Can start with an optional "+/" to search for data elements except in the top level, or "*/" to 
@@ -45,17 +52,66 @@ def is_tag_path_pattern(tag_path_pattern):
   tag_patterns, prefix = _split_tag_path_pattern(tag_path_pattern)
   for tag_pattern in tag_patterns:
     if not (
-      re.fullmatch(TAG_PATH_PATTERN_KEYWORD, tag_pattern) 
-      or re.fullmatch(TAG_PATH_PATERN_NUMBER, tag_pattern) 
-      or re.fullmatch(TAG_PATH_PATTERN_PRIVATE_CREATOR, tag_pattern)
-      or re.fullmatch(TAG_PATH_PATTERN_VR, tag_pattern)
+      _RE_TAG_PATH_PATTERN_KEYWORD.fullmatch(tag_pattern) 
+      or _RE_TAG_PATH_PATERN_NUMBER.fullmatch(tag_pattern) 
+      or _RE_TAG_PATH_PATTERN_PRIVATE_CREATOR.fullmatch(tag_pattern)
+      or _RE_TAG_PATH_PATTERN_VR.fullmatch(tag_pattern)
     ):
       return False
   
   return True
 
 
-def enumerate_elements_match_tag_path_patterns(ds, tag_paths, except_tag_paths, sequence_prefix=[]):
+@functools.lru_cache(maxsize=4096)
+def compile_tag_path_pattern(tag_path_pattern):
+  """
+  Parse a tag path pattern once and return its compiled form, which is a tuple (prefix, list of 
+  compiled tag patterns, minimum depth, maximum depth). The minimum and maximum depth are the 
+  number of nested data elements that a data element must have to match the tag path pattern 
+  according to the prefix. The maximum depth is `None` if there is no limit. Each compiled tag pattern is a tuple (keyword regex, tag number pattern, 
+  private tag pattern, VR) where the items that do not apply to the tag pattern are `None`. Tag 
+  number patterns are compiled with `_compile_tag_hexa_pattern`, and private tag patterns are 
+  tuples (compiled tag number pattern, private creator). The result is cached so that the same tag 
+  path pattern is not parsed again for each data element.
+  
+  Args:
+    tag_path_pattern (str)
+  
+  """
+  tag_patterns, prefix = _split_tag_path_pattern(tag_path_pattern)
+  compiled_tag_patterns = []
+  for tag_pattern in tag_patterns:
+    keyword_re = None
+    number = None
+    private = None
+    vr = None
+    if _RE_TAG_PATH_PATTERN_KEYWORD.fullmatch(tag_pattern):
+      keyword_re = re.compile(re.escape(tag_pattern).replace('\\*', '.*'))
+    if _RE_TAG_PATH_PATERN_NUMBER.fullmatch(tag_pattern):
+      number = _compile_tag_hexa_pattern(tag_pattern)
+    if _RE_TAG_PATH_PATTERN_PRIVATE_CREATOR.fullmatch(tag_pattern):
+      # The two first digits of the data element number are not part of the pattern
+      private = (_compile_tag_hexa_pattern(tag_pattern[:4] + 'XX' + tag_pattern[-2:]), tag_pattern[5:-3])
+    if _RE_TAG_PATH_PATTERN_VR.fullmatch(tag_pattern):
+      vr = tag_pattern[1:-1]
+    compiled_tag_patterns.append((keyword_re, number, private, vr))
+  
+  # If prefix is '', we search for data elements from the top level only. That is why the length 
+  # of `elem_sequence` must be equals to the length of `tag_patterns`. If prefix is '+/', we 
+  # search for data elements except in the top level, and the length of `elem_sequence` must be 
+  # greater than the length of `tag_patterns`. If prefix is '*/', the length of `elem_sequence` 
+  # must be greater or equal than the length of `tag_patterns`
+  if prefix == '':
+    min_depth, max_depth = len(tag_patterns), len(tag_patterns)
+  elif prefix == '+/':
+    min_depth, max_depth = len(tag_patterns)+1, None
+  else:
+    min_depth, max_depth = len(tag_patterns), None
+  
+  return prefix, tuple(compiled_tag_patterns), min_depth, max_depth
+
+
+def enumerate_elements_match_tag_path_patterns(ds, tag_paths, except_tag_paths):
   """
   Enumerator that returns all data elements of a Dataset that matches any of the tag path patterns 
   in `tag_paths` but none of the tag path patterns in `except_tag_paths`. For each data element 
@@ -66,34 +122,126 @@ def enumerate_elements_match_tag_path_patterns(ds, tag_paths, except_tag_paths,
     ds: pydicom Dataset
     tag_paths (list): List of tag path patterns
     except_tag_paths (list): List of tag path patterns
+  
+  """
+  rules = [(tag_paths, except_tag_paths)]
+  for elem, elem_full_tag, parent_elem, i_rules in enumerate_elements_match_tag_path_pattern_rules(ds, rules):
+    yield elem, elem_full_tag, parent_elem
+
+
+def enumerate_elements_match_tag_path_pattern_rules(ds, rules, sequence_prefix=[]):
+  """
+  Enumerator that returns all data elements of a Dataset that match at least one rule, and walks 
+  through the Dataset only once for several rules. Each rule is a tuple (tag_paths, 
+  except_tag_paths), and a data element matches a rule if it matches any of the tag path patterns 
+  in `tag_paths` but none of the tag path patterns in `except_tag_paths`. For each data element 
+  returned, it provides (the data element, the data element 8 hexa-digit tag number, the parent 
+  data element, the list of indexes of the matching rules).
+  
+  Args:
+    ds: pydicom Dataset
+    rules (list): List of tuples (list of tag path patterns, list of tag path patterns)
     sequence_prefix: Used for the function iteration
   
   """
+  # Sort and compile the tag path patterns once, when the function is called for the top level
+  if len(sequence_prefix) == 0:
+    rules = [(_prepare_tag_path_patterns(tag_paths), _prepare_tag_path_patterns(except_tag_paths)) for tag_paths, except_tag_paths in rules]
+  max_depth = _get_max_depth([tag_path for tag_paths, except_tag_paths in rules for tag_path in tag_paths])
+  
   for elem in ds:
     elem_sequence = sequence_prefix + [elem]
     if elem.VR == 'SQ':
+      # Skip the sequence items if their data elements are too deep to match any rule
+      if max_depth != None and len(elem_sequence) >= max_depth:
+        continue
       for item in elem:
-        yield from enumerate_elements_match_tag_path_patterns(item, tag_paths, except_tag_paths, elem_sequence)
+        yield from enumerate_elements_match_tag_path_pattern_rules(item, rules, elem_sequence)
     else:
-      
-      # Check if the data element matches none of the tag path patterns in `except_tag_paths`
-      match_except_tag_paths = False
-      for tag_path in except_tag_paths:
-        if _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path):
-          match_except_tag_paths = True
-          break
-      if match_except_tag_paths:
-        continue
-      
-      # Check if the data element matches at least one the tag path patterns in `tag_paths`
-      match_tag_paths = False
-      for tag_path in tag_paths:
-        if _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path):
-          match_tag_paths = True
-          break
-      if match_tag_paths:
+      matching_rules = [
+        i_rule for i_rule, (tag_paths, except_tag_paths) in enumerate(rules)
+        if _elem_sequence_match_tag_path_rule(elem_sequence, tag_paths, except_tag_paths)
+      ]
+      if len(matching_rules) > 0:
         elem_full_tag = '.'.join([_get_elem_tag_hexa(i) for i in elem_sequence])
-        yield elem, elem_full_tag, ds
+        yield elem, elem_full_tag, ds, matching_rules
+
+
+def sort_tag_path_patterns(tag_paths):
+  """
+  Return the list of tag path patterns sorted from the most selective to the least selective. 
+  Since a data element matches a list of tag path patterns as soon as it matches one of them, 
+  the order does not change the result, but the most selective patterns are the fastest to 
+  evaluate. Patterns without prefix come first since they only apply to data elements at a given 
+  depth, followed by patterns with fewer wildcard characters.
+  
+  Args:
+    tag_paths (list): List of tag path patterns
+  
+  """
+  return sorted(tag_paths, key=_tag_path_pattern_selectivity)
+
+
+def _prepare_tag_path_patterns(tag_paths):
+  """
+  Return the list of tag path patterns sorted with `sort_tag_path_patterns` and compiled with 
+  `compile_tag_path_pattern`.
+  
+  Args:
+    tag_paths (list): List of tag path patterns
+  
+  """
+  return [compile_tag_path_pattern(tag_path) for tag_path in sort_tag_path_patterns(tag_paths)]
+
+
+def _get_max_depth(compiled_tag_paths):
+  """
+  Return the maximum depth of the data elements that can match at least one of the compiled tag 
+  path patterns, or `None` if there is no limit.
+  
+  Args:
+    compiled_tag_paths (list): List of compiled tag path patterns
+  
+  """
+  max_depth = 0
+  for prefix, tag_patterns, tag_path_min_depth, tag_path_max_depth in compiled_tag_paths:
+    if tag_path_max_depth is None:
+      return None
+    max_depth = max(max_depth, tag_path_max_depth)
+  return max_depth
+
+
+def _tag_path_pattern_selectivity(tag_path_pattern):
+  """
+  Return a sort key for a tag path pattern. Lower values are more selective.
+  
+  Args:
+    tag_path_pattern (str)
+  
+  """
+  tag_patterns, prefix = _split_tag_path_pattern(tag_path_pattern)
+  nb_wildcards = sum(tag_pattern.count('*') + tag_pattern.count('X') + tag_pattern.count('@') for tag_pattern in tag_patterns)
+  return ('', '+/', '*/').index(prefix), nb_wildcards
+
+
+def _elem_sequence_match_tag_path_rule(elem_sequence, tag_paths, except_tag_paths):
+  """
+  Return `True` if the list of data elements `elem_sequence` matches none of the tag path patterns 
+  in `except_tag_paths`, and at least one of the tag path patterns in `tag_paths`.
+  
+  Args:
+    elem_sequence (list): List of nested data elements
+    tag_paths (list): List of compiled tag path patterns
+    except_tag_paths (list): List of compiled tag path patterns
+  
+  """
+  for tag_path in except_tag_paths:
+    if _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path):
+      return False
+  for tag_path in tag_paths:
+    if _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path):
+      return True
+  return False
 
 
 def _split_tag_path_pattern(tag_path_pattern):
@@ -115,74 +263,94 @@ def _split_tag_path_pattern(tag_path_pattern):
   
 def _get_elem_tag_hexa(elem):
   """
-  Returns a 8-hexadecimal digit corresponding to the data element tag.
+  Returns a 8-hexadecimal digit corresponding to the data element tag. Tag number patterns are 
+  matched against the tag integer directly, so this is only called for the data elements to 
+  return.
   
   Args:
     elem: pydicom Data Element
     
   """
-  return hex(elem.tag.group)[2:].upper().zfill(4) + hex(elem.tag.elem)[2:].upper().zfill(4)
+  return f'{elem.tag:08X}'
   
   
-def _elem_match_tag_pattern(elem, tag_pattern):
+def _elem_match_tag_pattern(elem, compiled_tag_pattern):
   """
   Return `True` if the pydicom Data Element `elem` matches the tag pattern.
   
   Args:
     elem: pydicom Data Element
-    tag_pattern (str): Tag pattern
+    compiled_tag_pattern (tuple): Tag pattern compiled by `compile_tag_path_pattern`
     
   """
+  keyword_re, number, private, vr = compiled_tag_pattern
+  
   # Check if it matches TAG_PATH_PATTERN_KEYWORD
-  if elem.keyword and re.fullmatch(TAG_PATH_PATTERN_KEYWORD, tag_pattern):
-    re_pattern = re.escape(tag_pattern)
-    re_pattern = re_pattern.replace('\*', '.*')
-    if re.fullmatch(re_pattern, elem.keyword):
-      return True
-
-  elem_tag_hexa = _get_elem_tag_hexa(elem)
+  if keyword_re != None and elem.keyword and keyword_re.fullmatch(elem.keyword):
+    return True
 
   # Check if it matches TAG_PATH_PATERN_NUMBER
-  if re.fullmatch(TAG_PATH_PATERN_NUMBER, tag_pattern):
-    if _tag_hexa_match_pattern(elem_tag_hexa, tag_pattern):
+  if number != None:
+    if _tag_int_match_pattern(elem.tag, number):
       return True
   
   # Check if it matches TAG_PATH_PATTERN_PRIVATE_CREATOR
-  if elem.private_creator and re.fullmatch(TAG_PATH_PATTERN_PRIVATE_CREATOR, tag_pattern):
-    if _tag_hexa_match_pattern(elem_tag_hexa[:4], tag_pattern[:4]) and _tag_hexa_match_pattern(elem_tag_hexa[-2:], tag_pattern[-2:]) and elem.private_creator == tag_pattern[5:-3]:
+  if private != None and elem.private_creator:
+    if _tag_int_match_pattern(elem.tag, private[0]) and elem.private_creator == private[1]:
       return True
   
   # Check if it matches TAG_PATH_PATTERN_VR
-  if re.fullmatch(TAG_PATH_PATTERN_VR, tag_pattern):
-    if elem.VR == tag_pattern[1:-1]:
+  if vr != None:
+    if elem.VR == vr:
       return True
   
   return False
   
 
-def _tag_hexa_match_pattern(tag_hexa, pattern):
+def _compile_tag_hexa_pattern(pattern):
   """
-  Return `True` if the hexadecimal value of a tag `tag_hexa` matches the pattern. `pattern` must 
-  match TAG_PATH_PATERN_NUMBER.
+  Compile a pattern that matches TAG_PATH_PATERN_NUMBER into a tuple of integers (care mask, fixed 
+  value, odd mask) so that a tag number can be compared with a few bitwise operations instead of 
+  digit by digit. Each hexadecimal digit is 4 bits:
+  - Fixed digits: 0xF in the care mask, and the digit in the fixed value
+  - "X": 0x0 in the care mask
+  - "@": 0x0 in the care mask, and 0x1 in the odd mask since odd digits have their lowest bit set
   
   Args:
-    tag_hexa (str): 8 hexadecimal-digit tag number
     pattern (str): hexadecimal pattern
     
   """
-  for i in range(len(tag_hexa)):
-    if pattern[i] == 'X':
-      continue
-    if pattern[i] == tag_hexa[i]:
-      continue
-    if pattern[i] == '@' and tag_hexa[i] in ('1', '3', '5', '7', '9', 'B', 'D', 'F'):
-      continue
-    return False
+  care_mask = 0
+  fixed_value = 0
+  odd_mask = 0
+  for digit in pattern:
+    care_mask <<= 4
+    fixed_value <<= 4
+    odd_mask <<= 4
+    if digit == '@':
+      odd_mask |= 0x1
+    elif digit != 'X':
+      care_mask |= 0xF
+      fixed_value |= int(digit, 16)
   
-  return True
+  return care_mask, fixed_value, odd_mask
+
+
+def _tag_int_match_pattern(tag_int, compiled_pattern):
+  """
+  Return `True` if the tag number `tag_int` matches the pattern compiled by 
+  `_compile_tag_hexa_pattern`.
+  
+  Args:
+    tag_int (int): Tag number, for example `elem.tag`
+    compiled_pattern (tuple)
+    
+  """
+  care_mask, fixed_value, odd_mask = compiled_pattern
+  return tag_int & care_mask == fixed_value and tag_int & odd_mask == odd_mask
 
 
-def _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path_pattern):
+def _elem_sequence_match_tag_path_pattern(elem_sequence, compiled_tag_path_pattern):
   """
   Return `True` if the list of data elements `elem_sequence` matches the tag path pattern. 
   `elem_sequence` is composed of each tag from the top level data element to the data element 
@@ -191,24 +359,13 @@ def _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path_pattern):
   
   Args:
     elem_sequence (list): List of nested data elements
-    tag_path_pattern (str)
+    compiled_tag_path_pattern (tuple): Tag path pattern compiled by `compile_tag_path_pattern`
     
   """
-  tag_patterns, prefix = _split_tag_path_pattern(tag_path_pattern)
+  prefix, tag_patterns, min_depth, max_depth = compiled_tag_path_pattern
 
-  # If prefix is '', we search for data elements from the top level only. That is why the length 
-  # of `elem_sequence` must be equals to the length of `tag_patterns`.
-  if prefix == '' and len(elem_sequence) != len(tag_patterns):
-    return False
-  
-  # If prefix is '+', we search for data elements except in the top level. That is why the length 
-  # of `elem_sequence` must be greater than the length of `tag_patterns`.
-  if prefix == '+/' and not len(elem_sequence) > len(tag_patterns):
-    return False
-    
-  # If prefix is '*/', we search for data elements except from the top level. That is why the length  
-  # of `elem_sequence` must be greater or equal than the length of `tag_patterns`.
-  if prefix == '*/' and not len(elem_sequence) >= len(tag_patterns):
+  # Check if the depth of the data element is allowed by the prefix
+  if len(elem_sequence) < min_depth or (max_depth != None and len(elem_sequence) > max_depth):
     return False
   
   # We start from the end and check if each data element matches the associated tag pattern. For 
@@ -217,9 +374,7 @@ def _elem_sequence_match_tag_path_pattern(elem_sequence, tag_path_pattern):
   # - The tag path pattern is */Sequence*.Seq*.0010XXXX
   # - We check if 00100000 matches 0010XXXX, and Sequence3 matches Seq* and Sequence2 
   #   matches Sequence*
-  for i in range(1, len(tag_patterns)+1):
-    tag_pattern = tag_patterns[-i]
-    elem = elem_sequence[-i]
+  for tag_pattern, elem in zip(reversed(tag_patterns), reversed(elem_sequence)):
     if not _elem_match_tag_pattern(elem, tag_pattern):
       return False
     
@@ -1,7 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from research_pacs.shared.util import EnvVarList
+from research_pacs.shared.util import EnvVarList, check_orthanc_hostname
 
 
 def get_env():
@@ -25,6 +25,13 @@ def get_env():
   # from the queue
   env.add('queue_max_attemps', 'RPACS_SQS_MAX_ATTEMPTS', cast=int, default=3)
   
+  # Number of seconds to wait for messages to arrive in the SQS queue when polling (long 
+  # polling). The maximum value is 20
+  env.add('queue_wait_seconds', 'RPACS_SQS_WAIT_TIME_SECONDS', cast=int, default=20)
+  
+  # Number of messages processed concurrently
+  env.add('workers', 'RPACS_WORKERS', cast=int, default=8)
+  
   # DNS hostname or IP address of the PostgreSQL database instance
   env.add('pg_host', 'RPACS_POSTGRESQL_HOSTNAME')
   
@@ -43,9 +50,7 @@ def get_env():
   # Hostname of the Orthanc server that stores the original DICOM files. Format: 
   # http[s]://hostname (do not include a trailing slash)
   env.add('src_orthanc_host', 'RPACS_SOURCE_ORTHANC_HOSTNAME')
-  host_lower = env.src_orthanc_host.lower()
-  assert host_lower.startswith('http://') or host_lower.startswith('https://'), 'Orthanc hostname format is incorrect'
-  assert not host_lower.endswith('/'), 'Orthanc hostname format is incorrect'
+  check_orthanc_hostname(env.src_orthanc_host)
   
   # User name to use to connect to the Orthanc server
   env.add('src_orthanc_user', 'RPACS_SOURCE_ORTHANC_USERNAME')
@@ -56,9 +61,7 @@ def get_env():
   # Hostname of the Orthanc server that stores the de-identified DICOM files. Format: 
   # http[s]://hostname (do not include a trailing slash)
   env.add('dst_orthanc_host', 'RPACS_DESTINATION_ORTHANC_HOSTNAME')
-  host_lower = env.dst_orthanc_host.lower()
-  assert host_lower.startswith('http://') or host_lower.startswith('https://'), 'Orthanc hostname format is incorrect'
-  assert not host_lower.endswith('/'), 'Orthanc hostname format is incorrect'
+  check_orthanc_hostname(env.dst_orthanc_host)
   
   # User name to use to connect to the Orthanc server
   env.add('dst_orthanc_user', 'RPACS_DESTINATION_ORTHANC_USERNAME')
@@ -74,4 +77,9 @@ def get_env():
   # Orthanc server and you are responsible for their deletion if needed
   env.add('preserve_files', 'RPACS_PRESERVE_ORIGINAL_FILES', default='no')
   
+  # Size in MB of each part, and number of parts uploaded in parallel, when a file larger than 
+  # 16 MB is written to Amazon S3 with a multipart upload
+  env.add('s3_multipart_chunksize_mb', 'RPACS_S3_MULTIPART_CHUNKSIZE_MB', cast=int, default=32)
+  env.add('s3_multipart_concurrency', 'RPACS_S3_MULTIPART_CONCURRENCY', cast=int, default=8)
+  
   return env
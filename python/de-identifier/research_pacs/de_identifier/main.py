@@ -1,11 +1,14 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import json
 import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import orjson
+from botocore.config import Config
 
 import research_pacs.shared.dicom_util as rpacs_dicom_util
 import research_pacs.shared.util as rpacs_util
@@ -20,6 +23,13 @@ logger.addHandler(logging.NullHandler())
 env = None
 client = None
 
+# Database clients of each worker thread. A database connection and its cursor cannot be shared 
+# between threads, so each worker thread creates its own clients the first time it needs them. 
+# The connections are kept open between messages, and closed when the program exits
+thread_local = threading.local()
+thread_clients = []
+thread_clients_lock = threading.Lock()
+
 
 def main():
   logger.info('Starting de-identifier')
@@ -31,12 +41,23 @@ def main():
     # Create the clients
     global client
     client = rpacs_util.ClientList()
-    client.add('db', DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db))
-    client.add('db_msg', DBKeyJsonValue(db_client=client.db, table_name="rpacs_related_msg"))
-    client.add('db_mapping', DBDicomMapping(db_client=client.db))
-    client.add('src_orthanc', OrthancClient(env.src_orthanc_host, env.src_orthanc_user, env.src_orthanc_pwd))
-    client.add('dst_orthanc', OrthancClient(env.dst_orthanc_host, env.dst_orthanc_user, env.dst_orthanc_pwd))
-    client.add('sqs', boto3.client('sqs', region_name=env.region))
+    # The HTTP connection pools must be large enough for the worker threads
+    pool_maxsize = max(10, env.workers)
+    client.add('src_orthanc', OrthancClient(env.src_orthanc_host, env.src_orthanc_user, env.src_orthanc_pwd, pool_maxsize))
+    client.add('dst_orthanc', OrthancClient(env.dst_orthanc_host, env.dst_orthanc_user, env.dst_orthanc_pwd, pool_maxsize))
+    boto_config = Config(max_pool_connections=pool_maxsize)
+    client.add('sqs', boto3.client('sqs', region_name=env.region, config=boto_config))
+    
+    # Transfer configuration used to write large files to Amazon S3 with a multipart upload
+    client.add('s3_transfer_cfg', rpacs_util.get_s3_transfer_config(env.s3_multipart_chunksize_mb, env.s3_multipart_concurrency))
+    
+    # Thread pool used to process the messages of each batch concurrently, since processing a 
+    # message mostly waits for Orthanc, Amazon S3 or Amazon Rekognition
+    client.add('executor', ThreadPoolExecutor(max_workers=env.workers))
+    
+    # Create the database clients of the main thread, which also creates the database tables if 
+    # they do not exist
+    get_db_clients()
     
   # Exit if any of the previous steps failed
   except Exception as e:
@@ -47,9 +68,10 @@ def main():
   killer = rpacs_util.GracefulKiller()
   while not killer.kill_now:
     
-    # Retrieve up to 10 messages from the SQS queue
+    # Retrieve up to 10 messages from the SQS queue. Long polling waits up to 
+    # `queue_wait_seconds` for messages to arrive, instead of returning immediately if the queue 
+    # is empty
     try:
-      messages_returned = False
       logger.debug(f'Retrieving messages from the SQS queue')
       sqs_response = client.sqs.receive_message(
         QueueUrl=env.queue_url,
@@ -57,45 +79,104 @@ def main():
         MaxNumberOfMessages=10,
         MessageAttributeNames=['All'],
         VisibilityTimeout=env.queue_timeout,
-        WaitTimeSeconds=1
+        WaitTimeSeconds=env.queue_wait_seconds
       )
       
       # Process each message and delete it from the queue if it succeeded
       messages = sqs_response['Messages'] if 'Messages' in sqs_response else []
       logger.debug(f'SQS returned {len(messages)} messages to process')
-      if len(messages) > 0:
-        messages_returned = True
-
-      for message in messages:
-        try:
-          
-          # Delete the message if it was served more than `queue_max_attemps`
-          nb_attempts = int(message['Attributes']['ApproximateReceiveCount'])
-          if nb_attempts > env.queue_max_attemps:
-            client.sqs.delete_message(QueueUrl=env.queue_url, ReceiptHandle=message['ReceiptHandle'])
-            continue
-          
-          process_message(message['Body'])
-          client.sqs.delete_message(QueueUrl=env.queue_url, ReceiptHandle=message['ReceiptHandle'])
-
-        except Exception as e:
-          logger.error(f'Failed to process the message ({nb_attempts} attempts) - {e}')
 
-    except Exception as e:
-      logger.error(f'Failed to poll messages from SQS - {e}')
+      # Process the messages concurrently, and wait for all of them to be processed
+      futures = [client.executor.submit(process_sqs_message, message) for message in messages]
+      messages_to_delete = [message for message, future in zip(messages, futures) if future.result() is True]
       
-    # Close the DB connection after each iteration
-    client.db.close()
+      # Delete the messages from the queue by batches of 10 messages
+      for i in range(0, len(messages_to_delete), 10):
+        delete_sqs_messages(messages_to_delete[i:i+10])
 
-    # Wait 5 seconds if the previous request returned no SQS message
-    if messages_returned is False:
-      logger.debug(f"Waiting 5 seconds")
+    except Exception as e:
+      logger.error(f'Failed to poll messages from SQS - {e}')
       killer.sleep(5)
 
   # Before the program exits
+  client.executor.shutdown()
+  client.src_orthanc.close()
+  client.dst_orthanc.close()
+  with thread_clients_lock:
+    for thread_client in thread_clients:
+      thread_client.db.close()
   logger.info('Stopping de-identifier')
 
 
+def get_db_clients():
+  """
+  Return a ClientList that contains the database clients (`db`, `db_msg` and `db_mapping`) of 
+  the current thread, and create them if needed.
+  
+  """
+  if not hasattr(thread_local, 'client'):
+    thread_client = rpacs_util.ClientList()
+    thread_client.add('db', DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db))
+    thread_client.add('db_msg', DBKeyJsonValue(db_client=thread_client.db, table_name="rpacs_related_msg"))
+    thread_client.add('db_mapping', DBDicomMapping(db_client=thread_client.db))
+    with thread_clients_lock:
+      thread_clients.append(thread_client)
+    thread_local.client = thread_client
+  return thread_local.client
+
+
+def process_sqs_message(message):
+  """
+  Process a SQS message. Returns `True` if the message must be deleted from the queue, because 
+  it was processed successfully or it was served more than `queue_max_attemps` times, or `False` 
+  if it must return to the queue.
+  
+  Args:
+    message (dict): SQS message returned by `receive_message`
+  
+  """
+  nb_attempts = None
+  try:
+    
+    # Delete the message if it was served more than `queue_max_attemps`
+    nb_attempts = int(message['Attributes']['ApproximateReceiveCount'])
+    if nb_attempts > env.queue_max_attemps:
+      return True
+    
+    # Re-use the database connection of this thread from the previous message if it is still 
+    # usable
+    get_db_clients().db.ensure_open()
+    
+    process_message(message['Body'])
+    return True
+
+  except Exception as e:
+    logger.error(f'Failed to process the message ({nb_attempts} attempts) - {e}')
+    return False
+
+
+def delete_sqs_messages(messages):
+  """
+  Delete up to 10 messages from the SQS queue with a single request.
+  
+  Args:
+    messages (list): List of SQS messages returned by `receive_message`
+  
+  """
+  try:
+    response = client.sqs.delete_message_batch(
+      QueueUrl=env.queue_url,
+      Entries=[
+        {'Id': str(i_message), 'ReceiptHandle': message['ReceiptHandle']}
+        for i_message, message in enumerate(messages)
+      ]
+    )
+    for failed in response.get('Failed', []):
+      logger.error(f"Failed to delete the message from SQS - {failed.get('Message')}")
+  except Exception as e:
+    logger.error(f'Failed to delete {len(messages)} messages from SQS - {e}')
+
+
 def process_message(msg_str):
   """
   Pass the message to another function depending on the event type (e.g. NewDICOM)
@@ -105,8 +186,8 @@ def process_message(msg_str):
   
   """
   try:
-    msg = json.loads(msg_str)
-    logger.debug(f"New message: {json.dumps(msg)}")
+    msg = orjson.loads(msg_str)
+    logger.debug('New message: %s', msg_str)
     event_type = msg['EventType']
   except:
     logger.error(f'Skipping malformed message: {msg_str}')
@@ -175,7 +256,7 @@ def process_new_dicom(msg):
     try:
       dicom_file = rpacs_util.load_file(dicom_source, env.region, 'bytes')
       instance_id = client.src_orthanc.upload_instance(dicom_file)
-      client.db_msg.upsert(instance_id, msg)
+      get_db_clients().db_msg.upsert(instance_id, msg)
       logger.info(f"Uploaded the local DICOM file to Orthanc - Instance ID={instance_id}")
     except Exception as e:
       raise Exception(f'Failed to upload the local DICOM file to Orthanc - {e}')
@@ -187,28 +268,32 @@ def process_new_dicom(msg):
     # Check if a message was previously stored in the database, with "instructions" on how to 
     # process this Orthanc instance
     try:
-      previous_msg = client.db_msg.get(instance_id)
-      if previous_msg != None:
-        if 'Source' in previous_msg:
-          previous_msg['OriginalSource'] = previous_msg['Source']
-        previous_msg['Source'] = dicom_source
-        msg = previous_msg
-        logger.debug(f"Modified the message: {json.dumps(previous_msg)}")
+      previous_msg = get_db_clients().db_msg.get(instance_id)
     except Exception as e:
       raise Exception(f'Failed to check if a related message was previously stored in the database - {e}')
     
     # Skip the message if it has an attribute `Skip=True` and delete the associated Orthanc 
-    # instance, because it was uploaded by the de-identifier
-    if 'Skip' in msg and msg['Skip'] == True:
+    # instance, because it was uploaded by the de-identifier. This is checked before the previous 
+    # message is merged, since there is nothing else to do with it
+    if previous_msg != None:
+      msg = previous_msg
+    if msg.get('Skip') == True:
       logger.info(f'Skipping the Orthanc instance (Skip=True)')
       client.src_orthanc.delete_instance(instance_id)
-      
+      return
+    
+    if previous_msg != None:
+      if 'Source' in previous_msg:
+        previous_msg['OriginalSource'] = previous_msg['Source']
+      previous_msg['Source'] = dicom_source
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Modified the message: %s', orjson.dumps(previous_msg).decode())
+    
     # Otherwise, process the message and delete the original DICOM file in Orthanc unless 
     # we need to preserve them
-    else:
-      process_new_dicom_orthanc(instance_id, msg)
-      if env.preserve_files.lower() == 'no':
-        client.src_orthanc.delete_instance(instance_id)
+    process_new_dicom_orthanc(instance_id, msg)
+    if env.preserve_files.lower() == 'no':
+      client.src_orthanc.delete_instance(instance_id)
 
       
 def process_new_dicom_orthanc(src_instance_id, msg):
@@ -258,7 +343,7 @@ def process_new_dicom_orthanc(src_instance_id, msg):
     try:
       if dst_dicom != None:
         if 'Destination' in msg:
-          rpacs_util.write_file(dst_dicom, msg['Destination'], env.region, 'bytes')
+          rpacs_util.write_file(dst_dicom, msg['Destination'], env.region, 'bytes', s3_transfer_config=client.s3_transfer_cfg)
           logger.info(f"Uploaded the de-identified DICOM file to \"{msg['Destination']}\"")
         else:
           dst_instance_id = client.dst_orthanc.upload_instance(dst_dicom)
@@ -277,14 +362,14 @@ def process_new_dicom_orthanc(src_instance_id, msg):
       continue
     elif key == 'TransformationsApplied':
       for t_key, t_value in value.items():
-        logger.info(f'Result: {key} {t_key}={json.dumps(t_value)}')
+        logger.info(f'Result: {key} {t_key}={orjson.dumps(t_value, default=str).decode()}')
     else:  
-      logger.info(f'Result: {key}={json.dumps(value)}')
+      logger.info(f'Result: {key}={orjson.dumps(value, default=str).decode()}')
   
   # Upload the detailed logs
   if 'LogFile' in msg:
     try:
-      rpacs_util.write_file(logs, msg['LogFile'], env.region, 'json')
+      rpacs_util.write_file(logs, msg['LogFile'], env.region, 'json', s3_transfer_config=client.s3_transfer_cfg)
       logger.info(f"Uploaded the detailed logs to \"{msg['LogFile']}\"")
     except Exception as e:
       logger.error(f'Failed to upload the log file - {e}')
@@ -319,7 +404,8 @@ def deidentify_dicom_orthanc(instance_id, src_dicom, config, logs):
   """
   # Create a DicomDeidentifier object and load the DICOM file
   try:
-    deidentifier = DicomDeidentifier(config, client.db, client.db_mapping)
+    db_clients = get_db_clients()
+    deidentifier = DicomDeidentifier(config, db_clients.db, db_clients.db_mapping)
   except Exception as e:
     raise Exception(f'Failed to initialize the DicomDeidentifier - {e}')
   
@@ -375,10 +461,18 @@ def deidentify_dicom_orthanc(instance_id, src_dicom, config, logs):
   
   # `apply_transformations` returns a transfer syntax if the de-identified DICOM file must be 
   # transcoded, or `None` if it should be sent as-is to the destination Orthanc server. If it must 
-  # be transcoded, we upload the de-identified DICOM file to the source Orthanc server, and we 
+  # be transcoded to RLE Lossless, we compress the pixel data locally with pydicom. For any other 
+  # transfer syntax, we upload the de-identified DICOM file to the source Orthanc server, and we 
   # download and return a transcoded version
-  dst_dicom = rpacs_dicom_util.export_dicom(deidentifier.dicom)
-  if dst_transfer_syntax != None:
+  if dst_transfer_syntax != None and rpacs_dicom_util.compress_dicom(deidentifier.dicom, dst_transfer_syntax) is True:
+    logger.debug(f'Transcoded the de-identified DICOM file to "{dst_transfer_syntax}" locally')
+    dst_transfer_syntax = None
+  
+  # The DICOM file is exported only once in each case, since each export holds a full copy of the 
+  # file in memory
+  if dst_transfer_syntax is None:
+    dst_dicom = rpacs_dicom_util.export_dicom(deidentifier.dicom)
+  else:
     try:
       
       # Temporarily change the SOP Instance ID before uploading the de-identified DICOM file to 
@@ -390,12 +484,13 @@ def deidentify_dicom_orthanc(instance_id, src_dicom, config, logs):
       # Upload the de-identified DICOM file to Orthanc. This new DICOM file should be ignored by the 
       # de-identifier
       tmp_instance_id = client.src_orthanc.upload_instance(dst_dicom)
-      client.db_msg.upsert(tmp_instance_id, {'Skip': True})
+      get_db_clients().db_msg.upsert(tmp_instance_id, {'Skip': True})
       
       # Download a transcoded version of the de-identified DICOM file, and we restore the SOP 
       # Instance ID to its original value
       dst_dicom = client.src_orthanc.download_instance_dicom(tmp_instance_id, transcode=dst_transfer_syntax)
       deidentifier.load_dicom(dst_dicom, initial_load=False)
+      dst_dicom = None
       rpacs_dicom_util.set_sop_instance_uid(deidentifier.dicom, src_sop_instance_uid)
       dst_dicom = rpacs_dicom_util.export_dicom(deidentifier.dicom)
       
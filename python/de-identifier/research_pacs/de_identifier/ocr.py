@@ -2,13 +2,42 @@
 # SPDX-License-Identifier: MIT-0
 
 import logging
+import math
+import threading
 from io import BytesIO
 
 import boto3
+import numpy as np
+from botocore.config import Config
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Frames larger than this size (in pixels) are downscaled before being sent to Amazon Rekognition. 
+# Rekognition returns relative box coordinates, so they are not affected by the downscale
+OCR_MAX_DIMENSION = 2048
+
+# Amazon Rekognition clients for each region
+_rekognition_clients = {}
+_rekognition_clients_lock = threading.Lock()
+
+
+def _get_rekognition_client(region):
+  """
+  Return an Amazon Rekognition client for this region. The client is created once and shared by all 
+  threads, so that its service model is loaded once and its HTTPS connections are reused. It is 
+  created while holding a lock, because the default boto3 session is not thread-safe.
+  
+  Args:
+    region (str): AWS Region where to use Amazon Rekognition
+  
+  """
+  with _rekognition_clients_lock:
+    if not region in _rekognition_clients:
+      boto_config = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 3}, tcp_keepalive=True)
+      _rekognition_clients[region] = boto3.client('rekognition', region_name=region, config=boto_config)
+    return _rekognition_clients[region]
+
 
 def get_box_coordinates(orthanc, instance_id, region, dimensions):
   """
@@ -25,13 +54,32 @@ def get_box_coordinates(orthanc, instance_id, region, dimensions):
   
   # Export the first frame as a JPEG file. It must be smaller than 5 MB in order to be passed as 
   # image bytes to Amazon Rekogniton. If the file is larger than 5 MB, we reduce the JPEG quality
-  # and retry
+  # and retry. Rather than decreasing the quality by 10 at each attempt, we estimate from the size 
+  # of the last file how much the quality must be decreased, assuming that the file size decreases 
+  # by about 30% every 10 quality points, so that a single retry is usually enough. The lowest 
+  # quality (50) is always tried before giving up
   try:
     logger.debug('Retrieving the first frame as JPEG image')
-    for quality in range(90, 40, -10):
-      first_frame = orthanc.download_instance_frame(instance_id, accept='image/jpeg', quality=quality)
+    
+    # Downscale the frame with Orthanc if it is larger than `OCR_MAX_DIMENSION`, to reduce the size 
+    # of the image sent to Amazon Rekognition
+    width, height = dimensions
+    resize = {}
+    if max(width, height) > OCR_MAX_DIMENSION:
+      scale = OCR_MAX_DIMENSION / max(width, height)
+      resize = {'width': max(1, round(width * scale)), 'height': max(1, round(height * scale))}
+    
+    quality = 90
+    first_frame = None
+    while True:
+      first_frame = orthanc.download_instance_frame(instance_id, accept='image/jpeg', quality=quality, **resize)
       if len(first_frame) < 5242880:
         break
+      if quality <= 50:
+        first_frame = None
+        break
+      nb_steps = max(1, math.ceil(math.log(len(first_frame) / 5242880) / math.log(1 / 0.7)))
+      quality = max(50, quality - 10 * nb_steps)
       first_frame = None
       
   except Exception as e:
@@ -41,25 +89,25 @@ def get_box_coordinates(orthanc, instance_id, region, dimensions):
     raise Exception('Failed to export the first frame as a JPEG file smaller than 5 MB, which is needed for Amazon Rekognition')
   
   # Detect text with Amazon Rekognition
-  client = boto3.client('rekognition', region_name=region)
+  client = _get_rekognition_client(region)
   response = client.detect_text(
     Image={'Bytes': first_frame},
     Filters={'WordFilter': {'MinConfidence': 90}}
   )
   
-  # Calculate and return the box coordinates with a minimum confidence of 90%
+  # Calculate and return the box coordinates with a minimum confidence of 90%. The relative 
+  # coordinates (left, top, width, height) of all words are scaled to pixels at once
   try:
-    result = []
-    if 'TextDetections' in response and len(response['TextDetections']) > 0:
-      width, height = dimensions
-      for detection in response['TextDetections']:
-        if detection['Type'] == 'WORD':
-          left = round(detection['Geometry']['BoundingBox']['Left'] * width)
-          top = round(detection['Geometry']['BoundingBox']['Top'] * height)
-          right = left + round(detection['Geometry']['BoundingBox']['Width'] * width) + 1
-          bottom = top + round(detection['Geometry']['BoundingBox']['Height'] * height) + 1
-          result.append([left, top, right, bottom])
-    return result
+    bounding_boxes = [
+      detection['Geometry']['BoundingBox'] for detection in response.get('TextDetections', []) 
+      if detection['Type'] == 'WORD'
+    ]
+    if len(bounding_boxes) == 0:
+      return []
+    boxes = np.array([[bb['Left'], bb['Top'], bb['Width'], bb['Height']] for bb in bounding_boxes], dtype=np.float64)
+    boxes = np.rint(boxes * np.array([width, height, width, height])).astype(np.int64)
+    boxes[:, 2:] += boxes[:, :2] + 1
+    return boxes.tolist()
     
   except Exception as e:
     raise Exception(f'Failed to detect text with Amazon Rekognition - {e}')
\ No newline at end of file
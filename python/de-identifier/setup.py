@@ -11,6 +11,7 @@ setup(
   install_requires=[
     'boto3',
     'numpy',
+    'orjson',
     'pydicom'
   ]
 )
\ No newline at end of file
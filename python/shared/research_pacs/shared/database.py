@@ -1,18 +1,41 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import json
 import logging
+import threading
 
+import orjson
 import psycopg2
+import psycopg2.pool
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Connection pools shared by the DB objects created with a `pool_size`, for each database
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Tables whose indexes were already created by this process. `CREATE INDEX IF NOT EXISTS` briefly 
+# locks the table even if the index exists, so it is only run once per process and table
+_indexed_tables = set()
+
+
+def _dumps_json(value):
+  """
+  Serialize a value to a JSON string with orjson, which is much faster than the `json` module for 
+  large documents like DICOM JSON documents. The result is passed as a string, because psycopg2 
+  would send bytes as `bytea`.
+  
+  Args:
+    value: JSON-serializable value
+  
+  """
+  return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
 
 class DB():
   
-  def __init__(self, host, port, user, password, database, create_db=True):
+  def __init__(self, host, port, user, password, database, create_db=True, pool_size=None):
     """
     Create a DB object.
     
@@ -23,6 +46,10 @@ class DB():
       Password: Database user password
       database: Name of the database
       create_db: Try to create the database if it does not exist
+      pool_size: If provided, the connection is taken from a pool of up to `pool_size` connections 
+        shared by all DB objects that connect to the same database, and `close` returns it to the 
+        pool instead of closing it. This removes the cost of opening a connection for short-lived 
+        DB objects
 
     """
     self.host = host
@@ -31,6 +58,7 @@ class DB():
     self.password = password
     self.database = database
     self.create_db = create_db
+    self.pool_size = pool_size
     self._connection = None
     self._cursor = None
 
@@ -48,14 +76,10 @@ class DB():
     try:
       if self._connection is None:
         logger.debug(f'PostgreSQL - Connecting to the database Host={self.host} Database={self.database}')
-        self._connection = psycopg2.connect(
-          user = self.user,
-          password = self.password, 
-          host = self.host,
-          port = self.port,
-          database = self.database,
-          connect_timeout = 5
-        )
+        if self.pool_size != None:
+          self._connection = self._get_pool().getconn()
+        else:
+          self._connection = psycopg2.connect(**self._get_connect_args())
         self._connection.autocommit = True
       return self._connection
     except Exception as e:
@@ -66,6 +90,30 @@ class DB():
         raise e
 
 
+  def _get_connect_args(self):
+    return {
+      'user': self.user,
+      'password': self.password,
+      'host': self.host,
+      'port': self.port,
+      'database': self.database,
+      'connect_timeout': 5
+    }
+
+
+  def _get_pool(self):
+    """
+    Return the connection pool for this database, and create it if needed.
+    
+    """
+    pool_key = (self.host, self.port, self.user, self.database)
+    with _pools_lock:
+      if not pool_key in _pools:
+        logger.debug(f'PostgreSQL - Creating a pool of {self.pool_size} connections')
+        _pools[pool_key] = psycopg2.pool.ThreadedConnectionPool(1, self.pool_size, **self._get_connect_args())
+      return _pools[pool_key]
+
+
   def _create_db(self):
     logger.debug(f'Creating the database {self.database}')
     db_create = DB(self.host, self.port, self.user, self.password, 'postgres', create_db=False)
@@ -94,7 +142,7 @@ class DB():
     except Exception as e:
       if retry is True:
         logger.debug(f'Failed to execute the SQL query, retrying - {e}')
-        self._close()
+        self._close(discard=True)
         self._connect()
         self._get_cursor()
         self._execute(query, *args, retry=False)
@@ -102,12 +150,17 @@ class DB():
         raise e
   
   
-  def _close(self):
+  def _close(self, discard=False):
     if self._connection != None:
       logger.debug('Closing the database')
       if self._cursor != None:
           self._cursor.close()
-      self._connection.close()
+      
+      # Return the connection to the pool, unless it is no longer usable
+      if self.pool_size != None:
+        self._get_pool().putconn(self._connection, close=(discard is True or self._connection.closed != 0))
+      else:
+        self._connection.close()
     self._connection = None
     self._cursor = None
   
@@ -121,13 +174,31 @@ class DB():
       raise Exception(err_msg)
       
       
-  def close(self):
+  def close(self, discard=False):
     try:
-      self._close()
+      self._close(discard)
     except Exception as e:
       logger.warning(f'Failed to close the database - {e}')
   
   
+  def ensure_open(self):
+    """
+    Check that the database connection, if any, is still usable and re-connect otherwise. This 
+    allows long-running programs to keep the same connection open between iterations.
+    
+    """
+    if self._connection is None:
+      return
+    try:
+      if self._connection.closed:
+        raise psycopg2.OperationalError('The connection is closed')
+      self._get_cursor().execute('SELECT 1;')
+    except psycopg2.Error as e:
+      logger.debug(f'PostgreSQL - The database connection is not usable, re-connecting - {e}')
+      self.close(discard=True)
+      self._connect()
+  
+  
   def fetchone(self):
     try:
       return self._cursor.fetchone()
@@ -146,6 +217,37 @@ class DB():
       raise Exception(err_msg)
 
 
+  def iterate(self, query, *args, itersize=1000):
+    """
+    Execute a query with a server-side cursor, and yield the results by batches of `itersize` 
+    rows, so that all the results are never loaded in memory at once. The cursor is declared `WITH 
+    HOLD` because the connection is in autocommit mode.
+    
+    Args:
+      query (str): SQL query
+      *args: Query arguments
+      itersize (int): Number of rows fetched from the database at once
+    
+    """
+    cursor = None
+    try:
+      if self._connection is None:
+        self._connect()
+      logger.debug(f'Executing the SQL query {query} with a server-side cursor')
+      cursor = self._connection.cursor(name=f'rpacs_{id(self)}', withhold=True)
+      cursor.itersize = itersize
+      cursor.execute(query, *args)
+      for row in cursor:
+        yield row
+    except Exception as e:
+      err_msg = f'Failed to execute the SQL query {query} - {e}'
+      logger.debug(err_msg)
+      raise Exception(err_msg)
+    finally:
+      if cursor != None and not cursor.closed:
+        cursor.close()
+
+
 class DBKeyJsonValue():
   """
   Store key / JSON items in a PostgreSQL instance.
@@ -192,21 +294,21 @@ class DBKeyJsonValue():
   def insert(self, key, value_dict):
     logger.debug(f'PostgreSQL - Inserting the JSON value for key="{key}" in the table "{self._table}"')
     sql_query = f"INSERT INTO {self._table} (key, value) VALUES (%s, %s);"
-    value_str = json.dumps(value_dict)
+    value_str = _dumps_json(value_dict)
     self._db.execute(sql_query, (key, value_str))
 
 
   def upsert(self, key, value_dict):
     logger.debug(f'PostgreSQL - Upserting the JSON value for key="{key}" in the table "{self._table}"')
-    sql_query = f"INSERT INTO {self._table} (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = %s;"
-    value_str = json.dumps(value_dict)
-    self._db.execute(sql_query, (key, value_str, value_str))
+    sql_query = f"INSERT INTO {self._table} (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;"
+    value_str = _dumps_json(value_dict)
+    self._db.execute(sql_query, (key, value_str))
     
     
   def update(self, key, new_value_dict):
     logger.debug(f'PostgreSQL - Updating the JSON value for key="{key}" in the table "{self._table}"')
     sql_query = f"UPDATE {self._table} SET value = %s WHERE key = %s;"
-    new_value_str = json.dumps(new_value_dict)
+    new_value_str = _dumps_json(new_value_dict)
     self._db.execute(sql_query, (new_value_str, key))
 
 
@@ -235,6 +337,17 @@ class DBDicomJson():
     self._db = db_client
     sql_query = f"CREATE TABLE IF NOT EXISTS {self._table} (instance_id VARCHAR(50) PRIMARY KEY, series_id VARCHAR(50), index_in_series INTEGER, add_time TIMESTAMP, dicom JSONB);"
     self._db.execute(sql_query)
+    
+    # Index the JSON documents for the JSONPath queries (`@?` operator), and the columns used to 
+    # filter by series and to sort the results
+    if not self._table in _indexed_tables:
+      sql_query = (
+        f"CREATE INDEX IF NOT EXISTS {self._table}_dicom_idx ON {self._table} USING GIN (dicom jsonb_path_ops); "
+        f"CREATE INDEX IF NOT EXISTS {self._table}_series_id_idx ON {self._table} (series_id); "
+        f"CREATE INDEX IF NOT EXISTS {self._table}_add_time_idx ON {self._table} (add_time DESC);"
+      )
+      self._db.execute(sql_query)
+      _indexed_tables.add(self._table)
 
 
   def upsert_instance(self, instance_id, series_id, index_in_series, dicom_dict):
@@ -249,15 +362,16 @@ class DBDicomJson():
       
     """
     logger.debug(f'PostgreSQL - Upserting the JSON document for DICOM instance ID={instance_id}')
-    sql_query = f"INSERT INTO {self._table} (instance_id, series_id, index_in_series, add_time, dicom) VALUES (%s, %s, %s, current_timestamp, %s) ON CONFLICT (instance_id) DO UPDATE SET series_id = %s, index_in_series = %s, add_time = current_timestamp, dicom = %s;"
-    dicom_str = json.dumps(dicom_dict)
-    self._db.execute(sql_query, (instance_id, series_id, index_in_series, dicom_str, series_id, index_in_series, dicom_str))
+    sql_query = f"INSERT INTO {self._table} (instance_id, series_id, index_in_series, add_time, dicom) VALUES (%s, %s, %s, current_timestamp, %s) ON CONFLICT (instance_id) DO UPDATE SET series_id = EXCLUDED.series_id, index_in_series = EXCLUDED.index_in_series, add_time = current_timestamp, dicom = EXCLUDED.dicom;"
+    dicom_str = _dumps_json(dicom_dict)
+    self._db.execute(sql_query, (instance_id, series_id, index_in_series, dicom_str))
 
 
-  def _get_sql_query(self, jsonpath_query, col_returned, limit=None, offset=None, order_results=False, additional_filter=None):
+  def _get_sql_query(self, jsonpath_query, col_returned, limit=None, offset=None, order_results=False, additional_filter=None, additional_args=()):
     """
     Parse and generate a SQL query according to the arguments passed. Returns the SQL query and the 
-    first argument to pass.
+    tuple of arguments to pass. `limit` and `offset` are passed as arguments rather than written 
+    in the SQL query.
     
     Args:
       jsonpath_query (str): Condition part of the JSON Path query
@@ -266,16 +380,27 @@ class DBDicomJson():
       offset (int): Skip `offset` rows before beginning to return rows
       order_results (bool): Order the results, most recently added come first
       additional_filter (str): Additional query condition
+      additional_args (tuple): Arguments of the additional query condition
     
     """
-    arg = f'$ ? ({jsonpath_query})' if jsonpath_query != '' else None
+    conditions = []
+    args = []
+    if jsonpath_query != '':
+      conditions.append('dicom @? %s')
+      args.append(f'$ ? ({jsonpath_query})')
+    if additional_filter != None:
+      conditions.append(additional_filter)
+      args.extend(additional_args)
     sql_query = f'SELECT {col_returned} FROM {self._table}'
-    sql_query += " WHERE dicom @? %s" if jsonpath_query != '' else ''
-    sql_query += f" AND {additional_filter}" if additional_filter != None else ''
+    sql_query += (' WHERE ' + ' AND '.join(conditions)) if len(conditions) > 0 else ''
     sql_query += ' ORDER BY add_time DESC' if order_results is True else ''
-    sql_query += f' LIMIT {limit}' if limit != None else ''
-    sql_query += f' OFFSET {offset};' if offset != None else ';'
-    return sql_query, arg
+    if limit != None:
+      sql_query += ' LIMIT %s'
+      args.append(int(limit))
+    if offset != None:
+      sql_query += ' OFFSET %s'
+      args.append(int(offset))
+    return sql_query + ';', tuple(args)
 
 
   def count_instances(self, jsonpath_query=''):
@@ -285,8 +410,8 @@ class DBDicomJson():
     
     """
     logger.debug(f'PostgreSQL - Counting the DICOM instances that match the query "{jsonpath_query}"')
-    sql_query, first_arg = self._get_sql_query(jsonpath_query, 'COUNT(instance_id), COUNT(DISTINCT series_id)')
-    self._db.execute(sql_query, (first_arg,))
+    sql_query, args = self._get_sql_query(jsonpath_query, 'COUNT(instance_id), COUNT(DISTINCT series_id)')
+    self._db.execute(sql_query, args)
     response = self._db.fetchone()
     return response[0], response[1]
     
@@ -297,8 +422,8 @@ class DBDicomJson():
     
     """
     logger.debug(f'PostgreSQL - Searching the DICOM instances that match the query "{jsonpath_query}"')
-    sql_query, first_arg = self._get_sql_query(jsonpath_query, 'instance_id', limit, order_results=True)
-    self._db.execute(sql_query, (first_arg,))
+    sql_query, args = self._get_sql_query(jsonpath_query, 'instance_id', limit, order_results=True)
+    self._db.execute(sql_query, args)
     return self._db.fetchall()
     
     
@@ -309,11 +434,22 @@ class DBDicomJson():
     
     """
     logger.debug(f'PostgreSQL - Searching the DICOM instances that match the query "{jsonpath_query}"')
-    sql_query, first_arg = self._get_sql_query(jsonpath_query, 'instance_id, dicom', limit, order_results=True)
-    self._db.execute(sql_query, (first_arg,))
+    sql_query, args = self._get_sql_query(jsonpath_query, 'instance_id, dicom', limit, order_results=True)
+    self._db.execute(sql_query, args)
     return self._db.fetchall()
     
     
+  def iter_instances(self, jsonpath_query):
+    """
+    Same as `search_instances`, but yield the Orthanc instance IDs and JSON documents one by one 
+    instead of loading all of them in memory.
+    
+    """
+    logger.debug(f'PostgreSQL - Iterating over the DICOM instances that match the query "{jsonpath_query}"')
+    sql_query, args = self._get_sql_query(jsonpath_query, 'instance_id, dicom', order_results=True)
+    return self._db.iterate(sql_query, args)
+    
+    
   def search_instances_with_series(self, jsonpath_query, limit=None, offset=None):
     """
     Return a list of Orthanc instance IDs that match the JSON Path query, with their associated 
@@ -321,11 +457,48 @@ class DBDicomJson():
     
     """
     logger.debug(f'PostgreSQL - Searching the DICOM instances that match the query "{jsonpath_query}"')
-    sql_query, first_arg = self._get_sql_query(jsonpath_query, 'instance_id, series_id, index_in_series, dicom', limit, offset, order_results=True)
-    self._db.execute(sql_query, (first_arg,))
+    sql_query, args = self._get_sql_query(jsonpath_query, 'instance_id, series_id, index_in_series, dicom', limit, offset, order_results=True)
+    self._db.execute(sql_query, args)
     return self._db.fetchall()
     
     
+  def search_and_count_instances(self, jsonpath_query, limit=None, offset=None):
+    """
+    Return the number of instances that match the JSON Path query, the number of distinct series 
+    that include these instances, and the instances of the requested page like 
+    `search_instances_with_series`. The JSON Path query is evaluated once for the counts and the 
+    page, and the DICOM tags are only read for the instances of the page.
+    
+    Args:
+      jsonpath_query (str): Condition part of the JSON Path query
+      limit (int): Maximum number of instances to return
+      offset (int): Skip `offset` instances before beginning to return instances
+    
+    """
+    logger.debug(f'PostgreSQL - Searching and counting the DICOM instances that match the query "{jsonpath_query}"')
+    match_query, args = self._get_sql_query(jsonpath_query, 'instance_id, series_id, add_time')
+    args = list(args)
+    page_query = 'SELECT instance_id, add_time FROM m ORDER BY add_time DESC'
+    if limit != None:
+      page_query += ' LIMIT %s'
+      args.append(int(limit))
+    if offset != None:
+      page_query += ' OFFSET %s'
+      args.append(int(offset))
+    sql_query = (
+      f'WITH m AS MATERIALIZED ({match_query[:-1]}) '
+      'SELECT c.total_instances, c.total_series, t.instance_id, t.series_id, t.index_in_series, t.dicom '
+      'FROM (SELECT COUNT(*) AS total_instances, COUNT(DISTINCT series_id) AS total_series FROM m) c '
+      f'LEFT JOIN ({page_query}) p ON TRUE '
+      f'LEFT JOIN {self._table} t ON t.instance_id = p.instance_id '
+      'ORDER BY p.add_time DESC;'
+    )
+    self._db.execute(sql_query, tuple(args))
+    rows = self._db.fetchall()
+    instances = [row[2:] for row in rows if row[2] != None]
+    return rows[0][0], rows[0][1], instances
+    
+    
   def list_instance_ids(self):
     """
     Return the full list of IDs of all Orthanc instances indexed in the database.
@@ -343,20 +516,21 @@ class DBDicomJson():
     
     """
     logger.debug(f'PostgreSQL - Checking if the DICOM instance ID={instance_id} matches the query "{jsonpath_query}"')
-    sql_query, first_arg = self._get_sql_query(jsonpath_query, 'COUNT(instance_id)', additional_filter='instance_id = %s')
-    self._db.execute(sql_query, (first_arg, instance_id))
-    return self._db.fetchone()[0] > 0
+    sql_query, args = self._get_sql_query(jsonpath_query, 'instance_id', limit=1, additional_filter='instance_id = %s', additional_args=(instance_id,))
+    self._db.execute(sql_query, args)
+    return self._db.fetchone() != None
     
     
   def has_access_to_series(self, jsonpath_query, series_id):
     """
-    Return True is the JSON Path query match at least once instance whose series ID is `series_id`.
+    Return True is the JSON Path query match at least once instance whose series ID is `series_id`. 
+    The query stops at the first matching instance rather than counting all of them.
     
     """
     logger.debug(f'PostgreSQL - Checking if the DICOM series ID={series_id} matches the query "{jsonpath_query}"')
-    sql_query, first_arg = self._get_sql_query(jsonpath_query, 'COUNT(instance_id)', additional_filter='series_id = %s')
-    self._db.execute(sql_query, (first_arg, series_id))
-    return self._db.fetchone()[0] > 0
+    sql_query, args = self._get_sql_query(jsonpath_query, 'instance_id', limit=1, additional_filter='series_id = %s', additional_args=(series_id,))
+    self._db.execute(sql_query, args)
+    return self._db.fetchone() != None
 
 
   def delete_instance(self, instance_id):
@@ -387,6 +561,12 @@ class DBExportTasks():
     self._db = db_client
     sql_query = f"CREATE TABLE IF NOT EXISTS {self._table} (id SERIAL PRIMARY KEY, user_name VARCHAR(250), status VARCHAR(10), add_time TIMESTAMP, parameters JSONB, results JSONB);"
     self._db.execute(sql_query)
+    
+    # Index the columns used to find the ongoing export tasks of a user
+    if not self._table in _indexed_tables:
+      sql_query = f"CREATE INDEX IF NOT EXISTS {self._table}_user_status_idx ON {self._table} (user_name, status, add_time);"
+      self._db.execute(sql_query)
+      _indexed_tables.add(self._table)
 
 
   def has_user_ongoing_exports(self, user):
@@ -412,7 +592,7 @@ class DBExportTasks():
     """
     logger.debug(f'PostgreSQL - Inserting a new export task')
     sql_query = f"INSERT INTO {self._table} (user_name, status, add_time, parameters, results) VALUES (%s, 'exporting', current_timestamp, %s, %s) RETURNING id;"
-    parameters_str = json.dumps(parameters_dict)
+    parameters_str = _dumps_json(parameters_dict)
     self._db.execute(sql_query, (user, parameters_str, "{}"))
     return self._db.fetchone()[0]
 
@@ -454,7 +634,7 @@ class DBExportTasks():
     """
     logger.debug(f'PostgreSQL - Updating the export task ID={task_id}')
     sql_query = f"UPDATE {self._table} SET status = %s, results = %s WHERE id = %s;"
-    results_str = json.dumps(results_dict)
+    results_str = _dumps_json(results_dict)
     self._db.execute(sql_query, (status, results_str, task_id,))
 
 
@@ -511,3 +691,39 @@ class DBDicomMapping():
     )
     self._db.execute(sql_query, (value_type, old_value, scope_type, scope_value, new_value))
     return self._db.fetchone()[0]
+
+
+  def add_or_get_mappings(self, mappings):
+    """
+    Similar to `add_or_get_mapping`, but add or get several mappings with a single SQL query 
+    instead of one query per mapping. Returns the list of values by which the initial values must 
+    be replaced, in the same order as `mappings`. If several mappings have the same value type, 
+    initial value and scope, the first `new_value` is used.
+    
+    The mappings are passed as one array per column and expanded with `unnest`, so that the SQL 
+    query is the same whatever the number of mappings. They are sorted by key so that concurrent 
+    queries lock the rows in the same order and cannot deadlock.
+    
+    Args:
+      mappings (list): List of tuples (value_type, old_value, new_value, scope_type, scope_value)
+    
+    """
+    unique_mappings = {}
+    for value_type, old_value, new_value, scope_type, scope_value in mappings:
+      unique_mappings.setdefault((value_type, old_value, scope_type, scope_value), new_value)
+    
+    results = {}
+    if len(unique_mappings) > 0:
+      sql_query = (
+        f"INSERT INTO {self._table} (value_type, old_value, scope_type, scope_value, new_value) "
+        "SELECT * FROM unnest(%s::varchar[], %s::text[], %s::varchar[], %s::text[], %s::text[]) "
+        "ON CONFLICT (value_type, old_value, scope_type, scope_value) DO UPDATE SET old_value=excluded.old_value "
+        "RETURNING value_type, old_value, scope_type, scope_value, new_value;"
+      )
+      sorted_mappings = sorted(unique_mappings.items(), key=lambda item: tuple(str(i) for i in item[0]))
+      sql_args = [list(column) for column in zip(*[(*key, new_value) for key, new_value in sorted_mappings])]
+      self._db.execute(sql_query, sql_args)
+      for value_type, old_value, scope_type, scope_value, new_value in self._db.fetchall():
+        results[(value_type, old_value, scope_type, scope_value)] = new_value
+    
+    return [results[(m[0], m[1], m[3], m[4])] for m in mappings]
@@ -1,6 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import functools
 import json
 import logging
 import re
@@ -10,6 +11,60 @@ import pydicom
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# RegEx pattern of one query condition (e.g. Tag StrEquals Value) in `translate_query_to_jsonpath`
+_RE_QUERY_CONDITION = re.compile(
+  r'([a-zA-Z0-9\.]+) +' # Tag
+  r'(?:' # One of the following
+  r'((?i:(?:Exists|NotExists|Empty|NotEmpty)))|' # Exists|NotExist|Empty|NotEmpty 
+  r'((?i:(?:NbEquals|NbNotEquals|NbGreater|NbLess))) +([0-9]+(?:\.[0-9]+)?)|' # NbEquals|NbNotEquals|NbGreater|NbLess number
+  r'((?i:(?:StrEquals|StrNotEquals))) +(?:([^"() ]+)|"([^"]*)")' # StrEquals|StrNotEquals string
+  r')'
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_tag_hexa_for_keyword(keyword):
+  """
+  Return the hexadecimal tag (e.g. 00080060) of a standard keyword (e.g. Modality), or `None` if 
+  the keyword is unknown. The results are cached since the same keywords are translated for each 
+  query or DICOM file.
+  
+  Args:
+    keyword (str): DICOM keyword
+  
+  """
+  tag_int = pydicom.datadict.tag_for_keyword(keyword)
+  if tag_int != None:
+    return hex(tag_int)[2:].upper().zfill(8)
+  return None
+
+
+@functools.lru_cache(maxsize=16384)
+def _get_tag_key_with_keyword(tag_hexa):
+  """
+  Return "xxxx,xxxx keyword" for a hexadecimal tag if a standard keyword exists for this tag, or 
+  "xxxx,xxxx" otherwise. The results are cached since the same tags appear in every DICOM file.
+  
+  Args:
+    tag_hexa (str): Hexadecimal tag (e.g. 00080060)
+  
+  """
+  # We don't use private dictionaries here
+  tag_hexa_formatted = f'{tag_hexa[0:4]},{tag_hexa[4:8]}'
+  tag_keyword = pydicom.datadict.keyword_for_tag(int(tag_hexa, 16))
+  if tag_keyword != '':
+    return f'{tag_hexa_formatted} {tag_keyword}'
+  return tag_hexa_formatted
+
+
+# "xxxx,xxxx keyword" for each tag of the standard DICOM dictionary, computed once at import. A 
+# plain dict lookup is cheaper than calling `_get_tag_key_with_keyword` for every tag of every DICOM 
+# file, which is still used for private and repeating group tags
+_TAG_KEYS = {
+  tag_hexa: _get_tag_key_with_keyword.__wrapped__(tag_hexa)
+  for tag_hexa in (f'{tag_int:08X}' for tag_int in pydicom.datadict.DicomDictionary)
+}
+
     
 def convert_dicom_to_json(dicom):
   """
@@ -37,30 +92,41 @@ def convert_dicom_to_json(dicom):
     
   """
   logger.debug('Converting a DICOM file to a JSON document')
-  # Function that modifies recursively the content of the JSON document returned by the pydicom 
+  # Function that modifies the content of the JSON document returned by the pydicom 
   # `to_json_dict()` function to make it easier to index and search DICOM data elements in the 
-  # PostgreSQL database
+  # PostgreSQL database. Sequence items are processed with an explicit stack of (source item, 
+  # new item) pairs rather than recursively
   def process_level(level_dict):
     new_level_dict = {}
-    for tag, element in level_dict.items():
-      # `element` may not contain an attribute `Value` if the tag is empty, or if it contains a 
-      # binary value like PixelData
-      if not 'Value' in element:
-        new_level_dict[tag] = ''
-      else:
+    stack = [(level_dict, new_level_dict)]
+    while len(stack) > 0:
+      src_dict, dst_dict = stack.pop()
+      for tag, element in src_dict.items():
+        # `element` may not contain an attribute `Value` if the tag is empty, or if it contains a 
+        # binary value like PixelData
+        values = element.get('Value')
+        if values is None:
+          dst_dict[tag] = ''
+          continue
+        
         # `element['Value']` should be a list, whatever the tag VM (Value Multiplicity)
-        if isinstance(element['Value'], list):
-          # Parse the content of `element['Value']` differently if the VR is SQ, PN or something 
-          # else. Numbers are converted to strings.
-          if element['vr'] == 'SQ':
-            new_level_dict[tag] = [process_level(i) for i in element['Value']]
-          elif element['vr'] == 'PN':
-            new_level_dict[tag] = [i['Alphabetic'] if 'Alphabetic' in i else str(i) for i in element['Value']]
-          else:
-            new_level_dict[tag] = [str(i) for i in element['Value']]
-          # If there is a single item in the list, remove the list and keep only the item value
-          if len(new_level_dict[tag]) == 1:
-            new_level_dict[tag] = new_level_dict[tag][0]
+        if not isinstance(values, list):
+          continue
+        
+        # Parse the content of `element['Value']` differently if the VR is SQ, PN or something 
+        # else. Numbers are converted to strings. The new sequence items are filled when they are 
+        # popped from the stack
+        vr = element['vr']
+        if vr == 'SQ':
+          new_values = [{} for i in values]
+          stack.extend(zip(values, new_values))
+        elif vr == 'PN':
+          new_values = [i['Alphabetic'] if 'Alphabetic' in i else str(i) for i in values]
+        else:
+          new_values = list(map(str, values))
+        
+        # If there is a single item in the list, remove the list and keep only the item value
+        dst_dict[tag] = new_values[0] if len(new_values) == 1 else new_values
     return new_level_dict
   
   # Generate and return a JSON document that contains both dataset and meta header information
@@ -86,19 +152,18 @@ def get_top_level_elem_value_from_dict(dicom_json, tag):
   """
   try:
     logger.debug(f'Retrieving the value of the top-level tag "{tag}"')
-    tag_int = pydicom.datadict.tag_for_keyword(tag)
-    if tag_int != None:
-      tag_key = hex(tag_int)[2:].upper().zfill(8)
-    else:
+    tag_key = _get_tag_hexa_for_keyword(tag)
+    if tag_key is None:
       tag_key = tag
-    if not tag_key in dicom_json:
+    value = dicom_json.get(tag_key)
+    if value is None:
       return ''
-    elif isinstance(dicom_json[tag_key], list):
-      return ', '.join(dicom_json[tag_key])
-    elif isinstance(dicom_json[tag_key], dict):
-      return json.dumps(dicom_json[tag_key])
+    elif isinstance(value, list):
+      return ', '.join(value)
+    elif isinstance(value, dict):
+      return json.dumps(value)
     else:
-      return str(dicom_json[tag_key])
+      return str(value)
       
   except Exception as e:
     err_msg = f'Failed to retrieve the value of the top-level tag "{tag}" - {e}'
@@ -123,14 +188,8 @@ def add_keywords_to_dicom_json(dicom_json):
     new_level_dict = {}
     for tag_hexa, value in level_dict.items():
       # Check if the tag hexadecimal value matches a known standard keyword in the pydicom 
-      # dictionary. We don't use private dictionaries here
-      tag_int = int(tag_hexa, 16)
-      tag_hexa_formatted = f'{tag_hexa[0:4]},{tag_hexa[4:8]}'
-      tag_keyword = pydicom.datadict.keyword_for_tag(tag_int)
-      if tag_keyword != '':
-        tag_key = f'{tag_hexa_formatted} {tag_keyword}'
-      else:
-        tag_key = tag_hexa_formatted
+      # dictionary
+      tag_key = _TAG_KEYS.get(tag_hexa) or _get_tag_key_with_keyword(tag_hexa)
       # Iterate recursively
       if isinstance(value, list):
         new_level_dict[tag_key] = [process_level(i) if isinstance(i, dict) else i for i in value]
@@ -166,16 +225,6 @@ def translate_query_to_jsonpath(query):
     if query.strip() == '':
       return ''
   
-    # RegEx pattern of one query condition (e.g. Tag StrEquals Value)
-    pattern = (
-      '([a-zA-Z0-9\.]+) +' # Tag
-      '(?:' # One of the following
-      '((?i:(?:Exists|NotExists|Empty|NotEmpty)))|' # Exists|NotExist|Empty|NotEmpty 
-      '((?i:(?:NbEquals|NbNotEquals|NbGreater|NbLess))) +([0-9]+(?:\.[0-9]+)?)|' # NbEquals|NbNotEquals|NbGreater|NbLess number
-      '((?i:(?:StrEquals|StrNotEquals))) +(?:([^"() ]+)|"([^"]*)")' # StrEquals|StrNotEquals string
-      ')'
-    )
-    
     pg_query = ''
     previous_left = 0
     str_between_conditions = ''
@@ -189,7 +238,7 @@ def translate_query_to_jsonpath(query):
       return new_string
     
     # For each condition found in the query string
-    conditions = re.finditer(pattern, query)
+    conditions = _RE_QUERY_CONDITION.finditer(query)
     for condition in conditions:
       cur_left, cur_right = condition.span()
       
@@ -206,12 +255,8 @@ def translate_query_to_jsonpath(query):
       tag_hexa_split = []
       tag_keywords = condition.group(1)
       for tag_keyword in tag_keywords.split('.'):
-        tag_int = pydicom.datadict.tag_for_keyword(tag_keyword)
-        if tag_int != None:
-          hexa = hex(tag_int)[2:].upper().zfill(8)
-          tag_hexa_split.append(hexa)
-        else:
-          tag_hexa_split.append(tag_keyword)
+        hexa = _get_tag_hexa_for_keyword(tag_keyword)
+        tag_hexa_split.append(hexa if hexa != None else tag_keyword)
       tag_hexa = '.'.join(tag_hexa_split)
       
       # If the operator is Exists, NotExists, Empty or NotEmpty
@@ -109,3 +109,25 @@ def export_dicom(dicom):
   out = BytesIO()
   dicom.save_as(out)
   return out.getvalue()
+
+
+def compress_dicom(dicom, transfer_syntax):
+  """
+  Compress the pixel data of a pydicom Dataset to `transfer_syntax` locally. Only RLE Lossless is 
+  encoded locally, with the native encoder of pydicom 2.2 or later. Returns `True` if the pixel 
+  data was compressed, or `False` for other transfer syntaxes or if the compression failed, in 
+  which case the Dataset is left unchanged and must be transcoded by Orthanc.
+  
+  Args:
+    dicom: pydicom Dataset
+    transfer_syntax (str): Target transfer syntax UID
+  
+  """
+  if transfer_syntax != pydicom.uid.RLELossless or not hasattr(dicom, 'compress'):
+    return False
+  try:
+    dicom.compress(transfer_syntax)
+    return True
+  except Exception as e:
+    logger.debug(f'Failed to compress the DICOM file to "{transfer_syntax}" locally - {e}')
+    return False
@@ -2,8 +2,11 @@
 # SPDX-License-Identifier: MIT-0
 
 import logging
+from http.cookiejar import DefaultCookiePolicy
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -15,10 +18,31 @@ class OrthancClient:
   
   """
   
-  def __init__(self, host, username, password):
+  def __init__(self, host, username, password, pool_maxsize=10):
     self._host = host
     self._username = username
     self._password = password
+    
+    # Reuse the same HTTP session and its pool of keep-alive connections for all requests to the 
+    # Orthanc server. Cookies are not persisted in the session, because the website forwards 
+    # requests from different users with this client
+    self._session = requests.Session()
+    self._session.auth = requests.auth.HTTPBasicAuth(username, password)
+    self._session.headers.update({'Connection': 'keep-alive'})
+    self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    # The pool must be at least as large as the number of threads that use the client 
+    # concurrently, otherwise connections are discarded after each request
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=Retry(total=3, backoff_factor=0.2))
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
+  
+  
+  def close(self):
+    """
+    Close the keep-alive connections to the Orthanc server.
+    
+    """
+    self._session.close()
   
   
   def _request(self, method, full_path, raise_error=True, **kwargs):
@@ -29,16 +53,15 @@ class OrthancClient:
       method (str): HTTP method (GET, POST...)
       full_path (str): URL path that must not start with a /
       raise_error: Raise an exception if the response code is 4xx or 5xx
-      **kwargs: Other keyword arguments passed to the `requests.request` function
+      **kwargs: Other keyword arguments passed to the `requests.Session.request` function
       
     """
     url = '%s/%s' %(self._host, full_path)
     try:
       logger.debug(f'Sending a {method} request to {url}')
-      response = requests.request(
+      response = self._session.request(
         method = method,
         url = url,
-        auth = requests.auth.HTTPBasicAuth(self._username, self._password),
         timeout = (5, 30),  # 5 seconds to connect, 30 seconds to read the first byte
         **kwargs
       )
@@ -134,7 +157,7 @@ class OrthancClient:
     return len(response.json())
 
 
-  def download_instance_frame(self, instance_id, accept='image/png', quality=90, frame=0):
+  def download_instance_frame(self, instance_id, accept='image/png', quality=90, frame=0, width=None, height=None):
     """
     Download one frame of the given DICOM instance as a PNG or JPEG image.
     
@@ -143,12 +166,22 @@ class OrthancClient:
       accept (str): Format to export ('image/png' or 'image/jpeg')
       quality (int): Quality for JPEG image between 1 and 100. Default is 90
       frame (int): Frame number
+      width (int, Optional): Width of the resized image. The frame is resized by Orthanc with the 
+        `rendered` route if `width` and `height` are provided
+      height (int, Optional): Height of the resized image
     
     """
     logger.debug(f'Downloading a frame of instance ID={instance_id} Frame={frame} Format={accept}')
-    url = f'instances/{instance_id}/frames/{frame}/preview'
+    params = []
+    if width != None and height != None:
+      url = f'instances/{instance_id}/frames/{frame}/rendered'
+      params += [f'width={width}', f'height={height}', 'smooth=1']
+    else:
+      url = f'instances/{instance_id}/frames/{frame}/preview'
     if accept == 'image/jpeg':
-      url += f'?quality={quality}'
+      params.append(f'quality={quality}')
+    if len(params) > 0:
+      url += '?' + '&'.join(params)
     response = self._request('GET', url, headers={'Accept': accept})
     return response.content
 
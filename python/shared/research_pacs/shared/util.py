@@ -1,23 +1,71 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import copy
+import io
 import json
 import os
 import re
 import logging
+import select
 import signal
-from threading import Event
+import threading
 
 import boto3
+import orjson
 import yaml
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Files larger than 16 MB are uploaded to S3 with a multipart upload, whose parts are sent in 
+# parallel, if a transfer configuration is passed to `write_file`. Smaller files are uploaded with 
+# a single PutObject request to avoid the cost of creating and completing a multipart upload
+S3_MULTIPART_THRESHOLD = 16*1024*1024
+
+
+# Use the LibYAML-based loader, which is much faster than the pure Python loader, if PyYAML was 
+# built with LibYAML
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# YAML files loaded with `load_file`, with their ETag (S3) or modification time (local file) when 
+# they were loaded, so that a file that did not change is not downloaded and parsed again. The 
+# cache is shared by the worker threads and guarded by a lock
+_yaml_cache = {}
+_yaml_cache_lock = threading.Lock()
+_YAML_CACHE_MAX_SIZE = 16
+
+# S3 clients that use the EC2 role or task role, for each region. boto3 clients are created from 
+# the default boto3 session, which is not thread-safe, so they are created while holding a lock
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def _get_s3_client(aws_region, s3_credentials=None):
+  """
+  Return a S3 client. Clients that use the EC2 role or task role are created once per region and 
+  shared by all threads, so that their HTTPS connections are reused.
+  
+  Args:
+    aws_region (str): AWS region where the S3 bucket resides
+    s3_credentials (dict): Optional S3 credentials passed to the boto3 S3 client
+  
+  """
+  with _s3_clients_lock:
+    if s3_credentials != None:
+      return boto3.client('s3', region_name=aws_region, **s3_credentials)
+    if not aws_region in _s3_clients:
+      boto_config = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10}, tcp_keepalive=True)
+      _s3_clients[aws_region] = boto3.client('s3', region_name=aws_region, config=boto_config)
+    return _s3_clients[aws_region]
+
 
 def load_file(location, aws_region, content_type='str', s3_credentials=None):
   """
-  Load and return a file either from Amazon S3 or from a local (or locally mounted) file system.
+  Load and return a file either from Amazon S3 or from a local (or locally mounted) file system. 
+  YAML documents are cached until the file changes.
   
   Args:
     location (str): File location in the format `s3://bucket/key` if the file is stored in Amazon 
@@ -33,14 +81,28 @@ def load_file(location, aws_region, content_type='str', s3_credentials=None):
     logger.debug(f'Load the file "{location}" as "{content_type}"')
     match = re.search('^s3:\/\/([^\/]+)\/(.+)$', location)
     
+    # YAML files loaded with the EC2 role or task role are cached. Return a copy of the cached 
+    # content if the file did not change since it was loaded, because callers may modify it
+    use_cache = content_type == 'yaml' and s3_credentials is None
+    if use_cache is True:
+      if match != None:
+        version = _get_s3_client(aws_region).head_object(Bucket=match.group(1), Key=match.group(2))['ETag']
+      else:
+        file_stat = os.stat(location)
+        version = (file_stat.st_mtime_ns, file_stat.st_size)
+      with _yaml_cache_lock:
+        cached = _yaml_cache.get(location)
+      if cached != None and cached[0] == version:
+        logger.debug(f'Reusing the cached content of the file "{location}"')
+        return copy.deepcopy(cached[1])
+    
     # Log the file from S3 if the location matches the S3 pattern
     if match != None:
-      if s3_credentials != None:
-        s3 = boto3.client('s3', region_name=aws_region, **s3_credentials)
-      else:
-        s3 = boto3.client('s3', region_name=aws_region)
+      s3 = _get_s3_client(aws_region, s3_credentials)
       s3_response = s3.get_object(Bucket=match.group(1), Key=match.group(2))
       content_bytes = s3_response['Body'].read()
+      if use_cache is True:
+        version = s3_response['ETag']
       
     # Otherwise, load the file from the local system, or locally-mounted file system
     else:
@@ -52,9 +114,16 @@ def load_file(location, aws_region, content_type='str', s3_credentials=None):
     elif content_type == 'str':
       return content_bytes.decode()
     elif content_type == 'json':
-      return json.loads(content_bytes.decode())
+      return orjson.loads(content_bytes)
     elif content_type == 'yaml':
-      return yaml.safe_load(content_bytes.decode())
+      content = yaml.load(content_bytes, Loader=_YAML_LOADER)
+      if use_cache is True:
+        cached = (version, copy.deepcopy(content))
+        with _yaml_cache_lock:
+          if len(_yaml_cache) >= _YAML_CACHE_MAX_SIZE and not location in _yaml_cache:
+            del _yaml_cache[next(iter(_yaml_cache))]
+          _yaml_cache[location] = cached
+      return content
 
   except Exception as e:
     msg_err = f'Failed to load the file {location} as "{content_type}" - {e}'
@@ -62,7 +131,24 @@ def load_file(location, aws_region, content_type='str', s3_credentials=None):
     raise Exception(msg_err)
 
 
-def write_file(content, location, aws_region, content_type='str', s3_credentials=None):
+def get_s3_transfer_config(multipart_chunksize_mb, multipart_concurrency):
+  """
+  Return the transfer configuration passed to `write_file` to upload large files to Amazon S3 
+  with a multipart upload.
+  
+  Args:
+    multipart_chunksize_mb (int): Size in MB of each part
+    multipart_concurrency (int): Number of parts uploaded in parallel
+  
+  """
+  return TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=multipart_chunksize_mb*1024*1024,
+    max_concurrency=multipart_concurrency
+  )
+
+
+def write_file(content, location, aws_region, content_type='str', s3_credentials=None, s3_transfer_config=None):
   """
   Write a file either to Amazon S3 or to a local (or locally mounted) file system.
   
@@ -74,6 +160,9 @@ def write_file(content, location, aws_region, content_type='str', s3_credentials
     content_type (str): Type of `content` (`str`, `bytes` or `json`)
     s3_credentials (dict): Optional S3 credentials passed to the boto3 S3 client. If no 
       credentials are provided, we use the EC2 role or task role
+    s3_transfer_config (TransferConfig): Optional transfer configuration returned by 
+      `get_s3_transfer_config`. If it is provided, files larger than its multipart threshold are 
+      written to Amazon S3 with a multipart upload
       
   """
   logger.debug(f'Write the file "{location}" as "{content_type}"')
@@ -89,11 +178,11 @@ def write_file(content, location, aws_region, content_type='str', s3_credentials
     
     # Save to S3 if the location matches the S3 pattern
     if match != None:
-      if s3_credentials != None:
-        s3 = boto3.client('s3', region_name=aws_region, **s3_credentials)
+      s3 = _get_s3_client(aws_region, s3_credentials)
+      if s3_transfer_config != None and len(content_bytes) >= s3_transfer_config.multipart_threshold:
+        s3.upload_fileobj(io.BytesIO(content_bytes), match.group(1), match.group(2), Config=s3_transfer_config)
       else:
-        s3 = boto3.client('s3', region_name=aws_region)
-      s3_response = s3.put_object(Body=content_bytes, Bucket=match.group(1), Key=match.group(2))
+        s3.put_object(Body=content_bytes, Bucket=match.group(1), Key=match.group(2))
       
     # Otherwise, save it to the local system
     else:
@@ -106,6 +195,19 @@ def write_file(content, location, aws_region, content_type='str', s3_credentials
     raise Exception(msg_err)
 
   
+def check_orthanc_hostname(hostname):
+  """
+  Raise an exception if the Orthanc hostname does not have the format http[s]://hostname, 
+  without a trailing slash.
+  
+  Args:
+    hostname (str): Orthanc hostname
+  
+  """
+  hostname_lower = hostname.lower()
+  assert hostname_lower.startswith(('http://', 'https://')) and not hostname_lower.endswith('/'), 'Orthanc hostname format is incorrect'
+
+
 class EnvVarList:
   """
   Retrieve and store environment variables. Environment variable values are accessible as  
@@ -171,19 +273,35 @@ class GracefulKiller:
   Intercept SIGINT and SIGTERM and enable the program to exit gracefully. Use the `sleep` function 
   instead of `time.sleep` to interrupt the sleep function when a signal is intercepted.
   
+  The signals are also written to a self-pipe with `signal.set_wakeup_fd`, so that `sleep` blocks 
+  in a single `select` call that returns as soon as a signal is delivered. This object must be 
+  created in the main thread.
+  
   """
   
   def __init__(self):
     self.kill_now = False
-    self.exit = Event()
+    self._pipe_r, self._pipe_w = os.pipe()
+    os.set_blocking(self._pipe_r, False)
+    os.set_blocking(self._pipe_w, False)
+    signal.set_wakeup_fd(self._pipe_w)
     signal.signal(signal.SIGINT, self._exit_gracefully)
     signal.signal(signal.SIGTERM, self._exit_gracefully)
 
 
   def _exit_gracefully(self, sig_num, *args):
-    self.exit.set()
     self.kill_now = True
     
     
   def sleep(self, seconds):
-    self.exit.wait(seconds)
+    if self.kill_now:
+      return
+    readable, _, _ = select.select([self._pipe_r], [], [], seconds)
+    
+    # Empty the pipe so that the next call to `sleep` blocks again
+    if readable:
+      try:
+        while os.read(self._pipe_r, 512):
+          pass
+      except BlockingIOError:
+        pass
@@ -97,4 +97,31 @@ def check_or_form_list_of_str(item, path):
   assert isinstance(item, list), f'{path} is not a string or a list of a strings'
   for i_value, value in enumerate(item):
     assert isinstance(value, str), f'{path} is not a string or a list of a strings'
-  return item
\ No newline at end of file
+  return item
+    
+    
+def check_dict_attributes(parent_dict, schema, path):
+  """
+  Check the attributes of the dict `parent_dict` against `schema`. Each key of `schema` is an 
+  attribute name, and each value is a dict that can contain:
+  - `Type` (type): Expected type of the attribute
+  - `Optional` (bool): Set to `True` if the attribute may not exist. Default is `False`
+  - `Default`: Value to set if the attribute is optional and does not exist
+  - `Values` (tuple): List of allowed values
+  
+  Args:
+    parent_dict (dict)
+    schema (dict)
+    path (str): Full path of `parent_dict` for logging purposes
+  
+  """
+  for attribute, rules in schema.items():
+    if not attribute in parent_dict:
+      assert rules.get('Optional', False) is True, f'{path}["{attribute}"] is missing'
+      if 'Default' in rules:
+        parent_dict[attribute] = rules['Default']
+      continue
+    value = parent_dict[attribute]
+    assert isinstance(value, rules['Type']), f'{path}["{attribute}"] is not a {rules["Type"].__name__}'
+    if 'Values' in rules:
+      assert value in rules['Values'], f'{path}["{attribute}"] must be equal to ' + ' or '.join(f'"{i}"' for i in rules['Values'])
@@ -10,6 +10,7 @@ setup(
   packages=['research_pacs.shared'],
   install_requires=[
     'boto3',
+    'orjson',
     'psycopg2-binary',
     'pydicom',
     'requests',
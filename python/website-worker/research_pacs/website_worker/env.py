@@ -1,7 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from research_pacs.shared.util import EnvVarList
+from research_pacs.shared.util import EnvVarList, check_orthanc_hostname
 
 
 def get_env():
@@ -20,6 +20,10 @@ def get_env():
   # Number of times a message can be received and attempted to be processed before it is removed 
   # from the queue
   env.add('queue_max_attemps', 'RPACS_SQS_MAX_ATTEMPTS', cast=int, default=3)
+  
+  # Number of seconds to wait for messages to arrive in the SQS queue when polling (long 
+  # polling). The maximum value is 20
+  env.add('queue_wait_seconds', 'RPACS_SQS_WAIT_TIME_SECONDS', cast=int, default=20)
 
   # DNS hostname or IP address of the PostgreSQL database instance
   env.add('pg_host', 'RPACS_POSTGRESQL_HOSTNAME')
@@ -39,9 +43,7 @@ def get_env():
   # Hostname of the Orthanc server that stores the de-identified DICOM files. Format: 
   # http[s]://hostname (don't include a trailing slash)
   env.add('orthanc_host', 'RPACS_ORTHANC_HOSTNAME')
-  host_lower = env.orthanc_host.lower()
-  assert host_lower.startswith('http://') or host_lower.startswith('https://'), 'Orthanc hostname format is incorrect'
-  assert not host_lower.endswith('/'), 'Orthanc hostname format is incorrect'
+  check_orthanc_hostname(env.orthanc_host)
   
   # User name to use to connect to the Orthanc server
   env.add('orthanc_user', 'RPACS_ORTHANC_USERNAME')
@@ -49,4 +51,9 @@ def get_env():
   # Password to use to connect to the Orthanc server
   env.add('orthanc_pwd', 'RPACS_ORTHANC_PASSWORD', password=True)
   
+  # Size in MB of each part, and number of parts uploaded in parallel, when a file larger than 
+  # 16 MB is written to Amazon S3 with a multipart upload
+  env.add('s3_multipart_chunksize_mb', 'RPACS_S3_MULTIPART_CHUNKSIZE_MB', cast=int, default=32)
+  env.add('s3_multipart_concurrency', 'RPACS_S3_MULTIPART_CONCURRENCY', cast=int, default=8)
+  
   return env
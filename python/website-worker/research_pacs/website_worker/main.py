@@ -35,6 +35,9 @@ def main():
     client.add('orthanc', OrthancClient(env.orthanc_host, env.orthanc_user, env.orthanc_pwd))
     client.add('sqs', boto3.client('sqs', region_name=env.region))
     
+    # Transfer configuration used to write large files to Amazon S3 with a multipart upload
+    client.add('s3_transfer_cfg', rpacs_util.get_s3_transfer_config(env.s3_multipart_chunksize_mb, env.s3_multipart_concurrency))
+    
     # This will store the last time when `clean_database` was called
     last_time_clean_database = None
 
@@ -47,9 +50,10 @@ def main():
   killer = rpacs_util.GracefulKiller()
   while not killer.kill_now:
     
-    # Retrieve up to 10 messages from the SQS queue
+    # Retrieve up to 10 messages from the SQS queue. Long polling waits up to 
+    # `queue_wait_seconds` for messages to arrive, instead of returning immediately if the queue 
+    # is empty
     try:
-      messages_returned = False
       logger.debug(f'Retrieving messages from the SQS queue')
       sqs_response = client.sqs.receive_message(
         QueueUrl=env.queue_url,
@@ -57,14 +61,12 @@ def main():
         MaxNumberOfMessages=10,
         MessageAttributeNames=['All'],
         VisibilityTimeout=env.queue_timeout,
-        WaitTimeSeconds=1
+        WaitTimeSeconds=env.queue_wait_seconds
       )
       
       # Process each message and delete it from the queue if it succeeded
       messages = sqs_response['Messages'] if 'Messages' in sqs_response else []
       logger.debug(f'SQS returned {len(messages)} messages to process')
-      if len(messages) > 0:
-        messages_returned = True
       
       for message in messages:
         try:
@@ -82,17 +84,13 @@ def main():
 
     except Exception as e:
       logger.error(f'Failed to poll messages from SQS - {e}')
+      killer.sleep(5)
 
     # Clean the database every 60 seconds
     if last_time_clean_database is None or (datetime.now() - last_time_clean_database).seconds > 60:
       clean_database()
       last_time_clean_database = datetime.now()
 
-    # Wait 5 seconds if the previous request returned no SQS message
-    if messages_returned is False:
-      logger.debug(f"Waiting 5 seconds")
-      killer.sleep(5)
-
   # Before the program exits
   logger.info('Stopping website worker')
 
@@ -224,10 +222,21 @@ def process_new_export(msg, msg_content):
       db_exports = DBExportTasks(db)
       parameters = db_exports.get_task(task_id)
       
-      # Retrieve the DICOM instances that match the query
+      # Retrieve the DICOM instances that match the query. The instances and their JSON document 
+      # are streamed from the database while they are exported, rather than loaded all at once.
+      # The SQL query only runs when the first instance is fetched, so the errors raised while
+      # iterating are handled like the errors raised here
       db_dicom_json = DBDicomJson(db)
-      instances = db_dicom_json.search_instances(parameters['JSONPathQuery'])
-      logger.debug(f'Export #{task_id} - Exporting {len(instances)} instances to Amazon S3')
+
+      def iter_instances_to_export():
+        try:
+          yield from db_dicom_json.iter_instances(parameters['JSONPathQuery'])
+        except Exception as e:
+          logger.error(f'Export #{task_id} - Failed to list the Orthanc instances to export - {e}')
+          raise Exception('Failed to list the Orthanc instances to export')
+
+      instances = iter_instances_to_export()
+      logger.debug(f'Export #{task_id} - Exporting the instances to Amazon S3')
       
     except Exception as e:
       logger.error(f'Export #{task_id} - Failed to list the Orthanc instances to export - {e}')
@@ -269,7 +278,7 @@ def process_new_export(msg, msg_content):
             
           try:
             s3_key = s3_prefix+'.dcm'
-            rpacs_util.write_file(file_bytes, s3_key, env.region, 'bytes', credentials)
+            rpacs_util.write_file(file_bytes, s3_key, env.region, 'bytes', credentials, client.s3_transfer_cfg)
           except Exception as e:
             logger.warning(f'Export #{task_id} - Failed to write the file to S3 - {e}')
             raise Exception('Failed to write the file to the S3 bucket, please check the S3 path and credentials')
@@ -294,7 +303,7 @@ def process_new_export(msg, msg_content):
               
             try:
               s3_key = f"{s3_prefix}_{frame}.{parameters['Format']}" if nb_frames > 1 else f"{s3_prefix}.{parameters['Format']}"
-              rpacs_util.write_file(file_bytes, s3_key, env.region, 'bytes', credentials)
+              rpacs_util.write_file(file_bytes, s3_key, env.region, 'bytes', credentials, client.s3_transfer_cfg)
             except Exception as e:
               logger.warning(f'Export #{task_id} - Failed to write the file to S3 - {e}')
               raise Exception('Failed to write the file to the S3 bucket, please check the S3 path and credentials')
@@ -305,7 +314,7 @@ def process_new_export(msg, msg_content):
           try:
             s3_key = s3_prefix+'.json'
             instance_json_keywords = rpacs_dicom_json.add_keywords_to_dicom_json(instance_json)
-            rpacs_util.write_file(instance_json_keywords, s3_key, env.region, 'json', credentials)
+            rpacs_util.write_file(instance_json_keywords, s3_key, env.region, 'json', credentials, client.s3_transfer_cfg)
           except Exception as e:
             logger.warning(f'Export #{task_id} - Failed to write the JSON file to S3 - {e}')
             raise Exception('Failed to write the JSON file to the S3 bucket, please check the S3 path and credentials')
@@ -356,7 +365,7 @@ def clean_database():
     db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db)
     db_dicom_json = DBDicomJson(db)
     ids_in_db = db_dicom_json.list_instance_ids()
-    ids_in_orthanc = client.orthanc.list_instance_ids()
+    ids_in_orthanc = set(client.orthanc.list_instance_ids())
     ids_to_delete = [i for i in ids_in_db if not i in ids_in_orthanc]
     for instance_id in ids_to_delete:
       db_dicom_json.delete_instance(instance_id)
@@ -1,7 +1,7 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from research_pacs.shared.util import EnvVarList
+from research_pacs.shared.util import EnvVarList, check_orthanc_hostname
 
 
 def get_env():
@@ -31,9 +31,7 @@ def get_env():
   # Hostname of the Orthanc server that stores the de-identified DICOM files. Format: 
   # http[s]://hostname (don't include a trailing slash)
   env.add('orthanc_host', 'RPACS_ORTHANC_HOSTNAME')
-  host_lower = env.orthanc_host.lower()
-  assert host_lower.startswith('http://') or host_lower.startswith('https://'), 'Orthanc hostname format is incorrect'
-  assert not host_lower.endswith('/'), 'Orthanc hostname format is incorrect'
+  check_orthanc_hostname(env.orthanc_host)
   
   # User name to use to connect to the Orthanc server
   env.add('orthanc_user', 'RPACS_ORTHANC_USERNAME')
@@ -38,6 +38,11 @@ app = flask.Flask(__name__)
 env = None
 client = None
 
+# Number of threads that process the HTTP requests, and number of PostgreSQL connections that they 
+# share. Each request takes a connection from the pool and returns it when the response is sent
+NB_THREADS = 4
+DB_POOL_SIZE = 2 * NB_THREADS
+
 
 def main():
   logger.info('Starting website')
@@ -60,7 +65,7 @@ def main():
 
   # Enable HTTP/1.1 and run the Flask application with Waitress
   WSGIRequestHandler.protocol_version = "HTTP/1.1"
-  serve(app, host='0.0.0.0', port=8080, threads=4, _quiet=True)
+  serve(app, host='0.0.0.0', port=8080, threads=NB_THREADS, _quiet=True)
 
   # Before the program exits
   logger.info('Stopping website')
@@ -109,9 +114,14 @@ def after_request_func(response):
   """Log the HTTP request and response in the access log file"""
   logger.debug(f'Sent the response - StatusCode={response.status_code}')
   client.access_logger.log_http_request(response)
+  return response
+
+
+@app.teardown_request
+def teardown_request_func(e):
+  """Return the database connection to the pool, even if the request raised an exception"""
   if g.get('db') != None:
     g.db.close()
-  return response
   
   
 @app.errorhandler(Exception)
@@ -217,7 +227,7 @@ def can_access_instance_or_series(f):
     if jsonpath_query == '':
       return f(*args, **kwargs)
     else:
-      g.db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db)
+      g.db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db, pool_size=DB_POOL_SIZE)
       db_dicom_json = DBDicomJson(g.db)
       if 'instance_id' in kwargs and db_dicom_json.has_access_to_instance(jsonpath_query, kwargs['instance_id']):
         return f(*args, **kwargs)
@@ -296,7 +306,7 @@ def search_page():
   except ValueError:
     return flask.render_template('search.html', error_message='Your query is invalid.')
   
-  g.db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db)
+  g.db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db, pool_size=DB_POOL_SIZE)
   db_dicom_json = DBDicomJson(g.db)
     
   # If the "Display" button was pressed
@@ -318,8 +328,7 @@ def search_page():
     # Retrieve the number of instances and series that match the query, and associated details 
     # for up to `env.results_per_page` from the offset `offset`
     try:
-      total_instances, total_series = db_dicom_json.count_instances(jsonpath_query)
-      instances_in_page = db_dicom_json.search_instances_with_series(jsonpath_query, limit=env.results_per_page, offset=offset)
+      total_instances, total_series, instances_in_page = db_dicom_json.search_and_count_instances(jsonpath_query, limit=env.results_per_page, offset=offset)
       series_ids_in_page = get_unique_series_ids(instances_in_page)
     except:
       logger.warning(f'Page {request.path} - Query: {query}')
@@ -477,7 +486,7 @@ def export_page():
       })
     )
   
-  g.db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db)
+  g.db = DB(env.pg_host, env.pg_port, env.pg_user, env.pg_pwd, env.pg_db, pool_size=DB_POOL_SIZE)
   db_exports = DBExportTasks(g.db)
   error_message = None
 